@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+context_bench
+~~~~~~~~
+
+Microbenchmark for the cost of creating nested contexts at various depths of
+the context stack.
+
+    python bench/context_bench.py
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import timeit
+
+import blueox
+
+ITERATIONS = 50000
+
+DEPTHS = (1, 10, 50)
+
+
+def relative_context():
+    with blueox.Context('.db'):
+        blueox.set('query_time', 0.1)
+
+
+def absolute_context():
+    with blueox.Context('request.db'):
+        blueox.set('query_time', 0.1)
+
+
+def run(name, func, depth):
+    contexts = [blueox.Context('request')]
+    for ndx in range(depth - 1):
+        contexts.append(blueox.Context('.sub%d' % ndx))
+
+    for ctx in contexts:
+        ctx.start()
+
+    try:
+        elapsed = timeit.timeit(func, number=ITERATIONS)
+    finally:
+        blueox.clear_contexts()
+
+    print "%-10s depth %-4d %8.2f usecs/context" % (
+        name, depth, elapsed / ITERATIONS * 1e6)
+
+
+def main():
+    for name, func in (('relative', relative_context),
+                       ('absolute', absolute_context)):
+        for depth in DEPTHS:
+            run(name, func, depth)
+
+
+if __name__ == '__main__':
+    main()
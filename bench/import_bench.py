@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+import_bench
+~~~~~~~~
+
+Benchmark for the cost of importing blueox in a fresh interpreter, with and
+without our transport (and ZeroMQ and msgpack) being imported.
+
+    python bench/import_bench.py
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import subprocess
+import sys
+import time
+
+ITERATIONS = 20
+
+STATEMENTS = (
+    ("python", "pass"),
+    ("import blueox", "import blueox"),
+    ("import blueox.network", "import blueox, blueox.network"),
+)
+
+
+def run(name, statement):
+    start_time = time.time()
+    for _ in range(ITERATIONS):
+        subprocess.check_call([sys.executable, '-c', statement])
+    elapsed = time.time() - start_time
+
+    print "%-24s %8.2f msecs/process" % (name, elapsed / ITERATIONS * 1e3)
+
+
+def main():
+    for name, statement in STATEMENTS:
+        run(name, statement)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+oxd_bench
+~~~~~~~~
+
+Benchmark for how many events per second an oxd can collect and write to log
+files.
+
+Starts an oxd (bin/oxd, or the one given) on random ports, pushes events at it
+as fast as it will take them, and waits for the last to show up in it's
+STATUS (and, with --pipeline, for it's stages to catch up). Fails if oxd
+reports dropping any of them.
+
+    python bench/oxd_bench.py [path/to/oxd] [oxd options]
+
+Comparing against an older oxd is a matter of checking it out somewhere:
+
+    git show HEAD~1:bin/oxd > /tmp/oxd.old
+    python bench/oxd_bench.py /tmp/oxd.old
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import msgpack
+import zmq
+
+from blueox import context
+from blueox import network
+
+EVENTS = 100000
+
+# Events are spread over this many types (so log files)
+TYPES = 10
+
+DONE_TYPE = 'bench.done'
+
+# How long we'll wait for oxd to answer on it's control port, and to catch up
+# with everything we've sent it.
+REQUEST_TIMEOUT = 10.0
+CATCH_UP_TIMEOUT = 120.0
+
+
+class OxdFailed(Exception):
+    pass
+
+
+def build_message(type_name):
+    ctx = context.Context(type_name, 'abc123')
+    with ctx:
+        ctx.set('method', 'GET')
+        ctx.set('uri', '/foo/bar?baz=1')
+        ctx.set('response.status', 200)
+
+    return network._serialize_context(ctx)
+
+
+def request(oxd, control_sock, cmd):
+    """Send oxd a control command, failing if it exits or doesn't answer"""
+    control_sock.send(msgpack.packb({'cmd': cmd}))
+
+    deadline = time.time() + REQUEST_TIMEOUT
+    while not control_sock.poll(100):
+        if oxd.poll() is not None:
+            raise OxdFailed("exited with %d" % oxd.returncode)
+        if time.time() > deadline:
+            raise OxdFailed("no answer to %s" % cmd)
+
+    return msgpack.unpackb(control_sock.recv())
+
+
+def supports(oxd_path, env, option):
+    """Check an oxd (maybe an older one) takes a command line option"""
+    proc = subprocess.Popen([sys.executable, oxd_path, '--help'], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return option in proc.communicate()[0]
+
+
+def caught_up(status):
+    if DONE_TYPE not in status['events']:
+        return False
+
+    return all(stage['depth'] == 0
+               for stage in status.get('pipeline', {}).values())
+
+
+def dropped(status):
+    """How many events oxd says it dropped (in any stage or writer)"""
+    parts = (status.get('pipeline', {}).values() +
+             status.get('writers', []))
+    return sum(part.get('dropped', 0) for part in parts)
+
+
+def run(oxd_path, oxd_args):
+    control_port = random.randint(30000, 40000)
+    collect_port = control_port + 1
+    log_path = tempfile.mkdtemp()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    cmd = [sys.executable, oxd_path,
+           '--control', '127.0.0.1:%d' % control_port,
+           '--collect', '127.0.0.1:%d' % collect_port,
+           '--log-path', log_path]
+
+    # Older oxds only collect over TCP anyway.
+    if supports(oxd_path, env, '--no-ipc'):
+        cmd.append('--no-ipc')
+
+    oxd = subprocess.Popen(cmd + oxd_args, env=env)
+
+    zmq_context = zmq.Context()
+    control_sock = zmq_context.socket(zmq.REQ)
+    control_sock.connect('tcp://127.0.0.1:%d' % control_port)
+    collect_sock = zmq_context.socket(zmq.PUSH)
+    collect_sock.connect('tcp://127.0.0.1:%d' % collect_port)
+
+    try:
+        # Wait for oxd to be up
+        request(oxd, control_sock, 'STATUS')
+
+        messages = [build_message('bench.type%d' % ndx)
+                    for ndx in range(TYPES)]
+
+        start_time = time.time()
+        for ndx in xrange(EVENTS):
+            collect_sock.send_multipart(messages[ndx % TYPES])
+
+        collect_sock.send_multipart(build_message(DONE_TYPE))
+        while True:
+            status = request(oxd, control_sock, 'STATUS')
+            if caught_up(status):
+                break
+            if time.time() - start_time > CATCH_UP_TIMEOUT:
+                raise OxdFailed("never caught up")
+
+            time.sleep(0.01)
+
+        elapsed = time.time() - start_time
+    finally:
+        try:
+            request(oxd, control_sock, 'SHUTDOWN')
+        except (OxdFailed, zmq.ZMQError):
+            if oxd.poll() is None:
+                oxd.kill()
+
+        oxd.wait()
+        control_sock.close(0)
+        collect_sock.close(0)
+        zmq_context.term()
+        shutil.rmtree(log_path)
+
+    name = ' '.join([os.path.basename(oxd_path)] + oxd_args)
+    lost = dropped(status)
+    if lost:
+        print "%-24s dropped %d of %d events" % (name, lost, EVENTS)
+        sys.exit(1)
+
+    print "%-24s %8d events/sec" % (name, EVENTS / elapsed)
+
+
+def main():
+    args = sys.argv[1:]
+    if args and not args[0].startswith('-'):
+        oxd_path = args.pop(0)
+    else:
+        oxd_path = os.path.join(os.path.dirname(__file__), '..', 'bin', 'oxd')
+
+    try:
+        run(oxd_path, args)
+    except OxdFailed, e:
+        print "%s failed: %s" % (oxd_path, e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
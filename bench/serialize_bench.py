@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+serialize_bench
+~~~~~~~~
+
+Microbenchmark for the per-event cost of serializing a context for sending.
+
+Compares the original approach (build a dict with to_dict() and msgpack.packb
+it) against blueox.network._serialize_context.
+
+    python bench/serialize_bench.py
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import struct
+import timeit
+
+import msgpack
+
+from blueox import context
+from blueox import network
+
+ITERATIONS = 100000
+
+
+def serialize_with_dict(ctx):
+    """The way we used to serialize contexts"""
+    context_dict = ctx.to_dict()
+    for key in ('host', 'type'):
+        if len(context_dict.get(key, "")) > 64:
+            raise ValueError("Value too long: %r" % key)
+
+    meta_data = struct.pack(network.META_STRUCT_FMT,
+                            network.META_STRUCT_VERSION, context_dict['end'],
+                            context_dict['host'], context_dict['type'])
+
+    context_data = msgpack.packb(context_dict)
+    return meta_data, context_data
+
+
+def build_context():
+    ctx = context.Context('request', 'abc123')
+    with ctx:
+        ctx.set('method', 'GET')
+        ctx.set('uri', '/foo/bar?baz=1')
+        ctx.set('response.status', 200)
+        ctx.set('response.size', 1024)
+        ctx.set('user', 1234)
+
+    return ctx
+
+
+def run(name, func, ctx):
+    elapsed = timeit.timeit(lambda: func(ctx), number=ITERATIONS)
+    print "%-24s %8.2f usecs/event" % (name, elapsed / ITERATIONS * 1e6)
+
+
+def main():
+    ctx = build_context()
+
+    run("to_dict + packb", serialize_with_dict, ctx)
+    run("_serialize_context", network._serialize_context, ctx)
+
+
+if __name__ == '__main__':
+    main()
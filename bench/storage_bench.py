@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+storage_bench
+~~~~~~~~
+
+Microbenchmark for the cost of creating a context with each of our context
+storage backends (see blueox.context.set_storage()).
+
+Backends whose dependencies aren't installed are skipped.
+
+    python bench/storage_bench.py
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import timeit
+
+import blueox
+from blueox import context
+from blueox import errors
+
+ITERATIONS = 50000
+
+
+def nested_context():
+    with blueox.Context('.db'):
+        blueox.set('query_time', 0.1)
+
+
+def run(name, storage_cls):
+    try:
+        storage = storage_cls()
+    except errors.Error, e:
+        print "%-10s skipped: %s" % (name, e)
+        return
+
+    context.set_storage(storage)
+    try:
+        with blueox.Context('request'):
+            elapsed = timeit.timeit(nested_context, number=ITERATIONS)
+    finally:
+        context.set_storage(context.ThreadStorage())
+
+    print "%-10s %8.2f usecs/context" % (name, elapsed / ITERATIONS * 1e6)
+
+
+def main():
+    run('thread', context.ThreadStorage)
+    run('greenlet', context.GreenletStorage)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,9 +19,10 @@ __url__ = 'https://github.com/rhettg/BlueOx'
 
 import logging
 import os
+import sys
 
 from . import utils
-from . import network
+from . import metrics
 from . import ports
 from .context import (
     Context, set, append, add, context_wrap, current_context, find_context,
@@ -30,11 +31,14 @@ from . import context as _context_mod
 from .errors import Error
 from .logger import LogHandler
 from .timer import timeit
+from .utils import register_encoder
+from .workers import executor
 
 log = logging.getLogger(__name__)
 
 
-def configure(host, port, recorder=None):
+def configure(host, port, recorder=None, threaded=False, batch=False,
+              limits_host=None, max_pending_bytes=None, shared=False):
     """Initialize blueox
 
     This instructs the blueox system where to send it's logging data. If blueox is not configured, log data will
@@ -42,33 +46,94 @@ def configure(host, port, recorder=None):
 
     Currently we support logging through the network (and the configured host and port) to a blueoxd instances, or
     to the specified recorder function
+
+    The host can also be an 'ipc://' endpoint (with no port) for an oxd on the
+    same host. A local oxd listening on it's default ipc path is used
+    automatically.
+
+    To spread events over several oxd instances, the host can be a list (or
+    tuple) of 'hostname:port' endpoints (with no port). Events are routed by
+    their id, so all the events for a request go to the same oxd while it's
+    available.
+
+    If threaded is set, finished contexts are serialized and sent by a
+    background thread rather than by the thread that finished them.
+
+    If batch is set, the background thread will also coalesce events into
+    batches. This requires an oxd that understands batches.
+
+    If limits_host is set, we'll periodically retrieve per-type limits (see
+    blueox.limits) from the oxd control port at that host.
+
+    If the oxd isn't keeping up, we'll hold up to max_pending_bytes of events
+    for it (see network.MAX_PENDING_BYTES) before we start dropping them.
+
+    If shared is set, all threads send through a single socket rather than
+    each having their own.
+
+    Our transport (and ZeroMQ) is only imported once we're configured to use
+    it.
     """
+    if limits_host:
+        from . import network
+        network.init_limits(limits_host)
+
     if recorder:
         _context_mod._recorder_function = recorder
-    elif host and port:
-        network.init(host, port)
+    elif host and (port or isinstance(host, (list, tuple)) or
+                   ports.is_ipc(host)):
+        from . import network
+        if max_pending_bytes is None:
+            max_pending_bytes = network.MAX_PENDING_BYTES
+
+        network.init(host, port, threaded=threaded, batch=batch,
+                     max_pending_bytes=max_pending_bytes, shared=shared)
         _context_mod._recorder_function = network.send
     else:
         log.info("Empty blueox configuration")
         _context_mod._recorder_function = None
 
+    # If we have nowhere to record to, we don't bother collecting anything.
+    _context_mod._recording_disabled = _context_mod._recorder_function is None
+
 
-def default_configure(host=None):
+def default_configure(host=None, threaded=False, batch=False,
+                      limits_host=None, max_pending_bytes=None,
+                      shared=False):
     """Configure BlueOx based on defaults
 
-    Accepts a connection string override in the form `localhost:3514`. Respects
+    Accepts a connection string override in the form `localhost:3514` (or an
+    'ipc://' endpoint, or a comma separated list of hosts). Respects
     environment variable BLUEOX_HOST
+
+    Limits are only retrieved if a limits_host is provided or environment
+    variable BLUEOX_LIMITS_HOST is set.
     """
     host = ports.default_collect_host(host)
-    hostname, port = host.split(':')
+    if ',' in host:
+        hostname, int_port = host.split(','), None
+    elif ports.is_ipc(host):
+        hostname, int_port = host, None
+    else:
+        hostname, port = host.split(':')
 
-    try:
-        int_port = int(port)
-    except ValueError:
-        raise Error("Invalid value for port")
+        try:
+            int_port = int(port)
+        except ValueError:
+            raise Error("Invalid value for port")
 
-    configure(hostname, int_port)
+    configure(hostname, int_port,
+              threaded=threaded,
+              batch=batch,
+              limits_host=ports.default_limits_host(limits_host),
+              max_pending_bytes=max_pending_bytes,
+              shared=shared)
 
 
 def shutdown():
-    network.close()
+    metrics.close()
+
+    # If we never imported our transport, there is nothing to close.
+    network = sys.modules.get(__name__ + '.network')
+    if network is not None:
+        network.close()
@@ -6,6 +6,10 @@ blueox.context
 This module provides the concept of 'Context' for collecting data that will
 generate a log event.
 
+Active contexts are kept in a stack for each thread. Other storage (see
+set_storage()) can give each greenlet (GreenletStorage) it's own stack
+instead.
+
 :copyright: (c) 2012 by Rhett Garber
 :license: ISC, see LICENSE for more details.
 
@@ -17,9 +21,16 @@ import struct
 import threading
 import functools
 import logging
+import zlib
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
 
+from . import errors
 from . import utils
-from . import network
+from . import limits
 
 log = logging.getLogger(__name__)
 
@@ -27,9 +38,15 @@ log = logging.getLogger(__name__)
 # to.
 _recorder_function = None
 
+# Set when we've been explicitly configured to not record anything. Contexts
+# are then created disabled so they don't bother collecting data. (We don't do
+# this when we just haven't been configured, as it's handy to be able to
+# inspect contexts in tests)
+_recording_disabled = False
+
 
 class Context(object):
-    __slots__ = ["name", "data", "id", "_writable", "start_time",
+    __slots__ = ["name", "_data", "id", "_writable", "start_time", "end_time",
                  "_sample_checks", "enabled"]
 
     def __init__(self, type_name, id=None, sample=None):
@@ -54,56 +71,60 @@ class Context(object):
 
             ('..', 0.25) will enable logging for 25% of the parent contexts.
             ('.', 0.25) will enable logging for 25% of the current context.
+
+            A third element, a sample key, makes the decision deterministic by
+            hashing the sample parent's id ('id') or the value of some other
+            key set on the sample parent. Every context (and every process)
+            sampling on the same value will then make the same decision:
+
+            ('^', 0.05, 'id') will enable logging for 5% of request ids.
+            ('^', 0.05, 'user') will enable logging for 5% of users.
         """
         if type_name.startswith('.'):
             parent_ctx = current_context()
 
             if type_name.startswith('..'):
                 raise ValueError("Invalid type name")
-
-            clean_type_name = type_name[1:]
         elif type_name.startswith('^'):
             parent_ctx = top_context()
 
             if not type_name.startswith('^.'):
                 raise ValueError("Invalid relative type name syntax")
-
-            clean_type_name = type_name[2:]
         else:
             parent_ctx = find_closest_context(type_name)
-            if parent_ctx is None:
-                clean_type_name = type_name
-            else:
+            if parent_ctx is not None:
                 if parent_ctx.name == type_name:
                     # Previously we crashed with this being an invalid name,
                     # but we probably don't want to crash even though it's a
                     # highly unusual situation.
                     log.warning("Duplicate type name: %r", type_name)
-                    clean_type_name = type_name
-                elif type_name.startswith(parent_ctx.name):
+                elif not type_name.startswith(parent_ctx.name):
                     # If the parent is a prefix of our current type name, we'll
                     # keep it as the parent, otherwise we're a separate branch
                     # of the context tree.
-                    clean_type_name = type_name[len(parent_ctx.name) + 1:]
-                else:
-                    clean_type_name = type_name
                     parent_ctx = None
 
-        if parent_ctx is None:
-            self.name = clean_type_name
-        else:
-            parent_parts = sorted(enumerate(parent_ctx.name.split('.')),
-                                  reverse=True)
-            for ppart_ndx, ppart in parent_parts:
-                if ppart == type_name.split('.')[1]:
-                    self.name = '.'.join(parent_ctx.name.split('.')[:ppart_ndx]
-                                         + type_name.split('.')[1:])
-                    break
+        if parent_ctx is not None and not parent_ctx.enabled:
+            # Nothing under a disabled context is going to be recorded, so
+            # we'll skip working out exactly what our name should be.
+            if type_name.startswith('.'):
+                self.name = parent_ctx.name + type_name
+            elif type_name.startswith('^'):
+                self.name = parent_ctx.name + type_name[1:]
             else:
-                self.name = '.'.join((parent_ctx.name, clean_type_name))
+                self.name = type_name
+        elif parent_ctx is not None:
+            self.name = _resolve_name(parent_ctx.name, type_name)
+        elif type_name.startswith('.'):
+            self.name = type_name[1:]
+        elif type_name.startswith('^'):
+            self.name = type_name[2:]
+        else:
+            self.name = type_name
 
-        self.data = {}
+        self._data = utils.FlatStore()
         self.start_time = time.time()
+        self.end_time = None
         self._sample_checks = {}
 
         if id is not None:
@@ -117,10 +138,10 @@ class Context(object):
             self.id = (struct.pack(">L", time.time()) + os.urandom(12)).encode(
                 'hex')
 
-        if parent_ctx and not parent_ctx.enabled:
+        if _recording_disabled or (parent_ctx and not parent_ctx.enabled):
             self.enabled = False
         elif sample:
-            sample_name, rate = sample
+            sample_name, rate = sample[:2]
 
             if sample_name == type_name or sample_name == '.':
                 sample_parent_ctx = self
@@ -131,13 +152,26 @@ class Context(object):
             else:
                 sample_parent_ctx = _get_context(sample_name)
 
-            if sample_parent_ctx == self:
+            if len(sample) > 2:
+                self.enabled = sample_parent_ctx.hash_sampled(sample[2], rate)
+            elif sample_parent_ctx == self:
                 self.enabled = bool(random.random() <= rate)
             else:
                 self.enabled = sample_parent_ctx.sampled_for(type_name, rate)
         else:
             self.enabled = True
 
+        # Operators may have limited how many of these events we generate (see
+        # blueox.limits)
+        if self.enabled and limits._limits:
+            self.enabled = limits.allow(self.name)
+
+        # If we can't keep up with sending events, we'll keep fewer of the
+        # details.
+        if (self.enabled and parent_ctx is not None and
+                limits.shedder.keep_ratio < 1.0):
+            self.enabled = limits.shedder.allow(self.name)
+
         self._writable = False
 
     @property
@@ -150,37 +184,77 @@ class Context(object):
             self._sample_checks[name] = bool(random.random() <= rate)
         return self._sample_checks[name]
 
+    def hash_sampled(self, key, rate):
+        """Deterministic sampling based on the value of key
+
+        The key 'id' is our id, otherwise the value is found in our data. If
+        there is no such value, our id is used.
+        """
+        value = None
+        if key != 'id':
+            value = self._data.get(key)
+
+        if value is None:
+            value = self.id
+
+        return hash_sampled(value, rate)
+
+    @property
+    def data(self):
+        """Data set for this context, as a nested dict
+
+        This is built from our data when asked for, so can't be changed
+        (use set()).
+        """
+        return ContextData(self._data.to_dict())
+
+    @data.setter
+    def data(self, value):
+        raise AttributeError("Context data can't be replaced, use set()")
+
+    def get(self, key, default=None):
+        """Retrieve a value set for this context (see set()), or default"""
+        return self._data.get(key, default)
+
     def set(self, key, *args, **kwargs):
-        if not self.writable:
+        if not self._writable:
             raise ValueError()
 
         if args and kwargs:
             raise ValueError()
 
+        if not self.enabled:
+            return
+
         if len(args) > 1:
-            utils.set_deep(self.data, key, args)
+            self._data.set(key, args)
         elif args:
-            utils.set_deep(self.data, key, args[0])
+            self._data.set(key, args[0])
         elif kwargs:
-            existing_value = utils.get_deep(self.data, key, {})
+            existing_value = self._data.get(key, {})
             existing_value.update(kwargs)
-            utils.set_deep(self.data, key, existing_value)
+            self._data.set(key, existing_value)
 
     def append(self, key, value):
-        if not self.writable:
+        if not self._writable:
             raise ValueError()
 
-        existing_value = utils.get_deep(self.data, key, [])
+        if not self.enabled:
+            return
+
+        existing_value = self._data.get(key, [])
         existing_value.append(value)
         if len(existing_value) == 1:
-            utils.set_deep(self.data, key, existing_value)
+            self._data.set(key, existing_value)
 
     def add(self, key, value):
-        if not self.writable:
+        if not self._writable:
             raise ValueError()
 
-        existing_value = utils.get_deep(self.data, key, 0)
-        utils.set_deep(self.data, key, existing_value + value)
+        if not self.enabled:
+            return
+
+        self._data.set(key, self._data.get(key, 0) + value)
 
     def to_dict(self):
         return {
@@ -189,8 +263,8 @@ class Context(object):
             'host': os.uname()[1],
             'pid': os.getpid(),
             'start': self.start_time,
-            'end': time.time(),
-            'body': self.data
+            'end': self.end_time or time.time(),
+            'body': self._data.to_dict()
         }
 
     def start(self):
@@ -203,6 +277,10 @@ class Context(object):
 
     def done(self):
         self.stop()  # Just be sure
+
+        # Recorders may not get to this context right away (see
+        # network.SenderThread), so we note when we actually finished.
+        self.end_time = time.time()
         if self.enabled and _recorder_function:
             _recorder_function(self)
 
@@ -220,14 +298,226 @@ class Context(object):
         self.done()
 
 
-threadLocal = threading.local()
+def hash_sampled(value, rate):
+    """Decide if the value is included in a sample of the specified rate
+
+    Unlike random sampling, the same value always gets the same decision, in
+    any process. Values sampled at a lower rate are also sampled at any higher
+    rate.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+
+    return (zlib.crc32(value) & 0xffffffff) < rate * 0x100000000
+
+
+# How many names we'll remember for _resolve_name() and _name_prefixes().
+# Context names are almost always literals in application code, but we don't
+# want to grow without bound if someone is generating them.
+MAX_MEMOIZED_NAMES = 4096
+
+_resolved_names = {}
+_prefixes_by_name = {}
+
+
+def _resolve_name(parent_name, type_name):
+    """Determine the name of a new context given it's parent's name"""
+    key = (parent_name, type_name)
+    try:
+        return _resolved_names[key]
+    except KeyError:
+        pass
+
+    if type_name.startswith('.'):
+        clean_type_name = type_name[1:]
+    elif type_name.startswith('^'):
+        clean_type_name = type_name[2:]
+    elif parent_name == type_name:
+        clean_type_name = type_name
+    else:
+        clean_type_name = type_name[len(parent_name) + 1:]
+
+    parent_parts = parent_name.split('.')
+    type_parts = type_name.split('.')
+    for ppart_ndx in range(len(parent_parts) - 1, -1, -1):
+        if parent_parts[ppart_ndx] == type_parts[1]:
+            name = '.'.join(parent_parts[:ppart_ndx] + type_parts[1:])
+            break
+    else:
+        name = '.'.join((parent_name, clean_type_name))
+
+    if len(_resolved_names) >= MAX_MEMOIZED_NAMES:
+        _resolved_names.clear()
+
+    _resolved_names[key] = name
+    return name
+
+
+def _name_prefixes(name):
+    """All the prefixes of a name, from shortest to longest.
+
+    For example, 'foo.bar' results in ('foo', 'foo.bar')
+    """
+    try:
+        return _prefixes_by_name[name]
+    except KeyError:
+        pass
+
+    parts = name.split('.')
+    prefixes = tuple('.'.join(parts[:ndx]) for ndx in range(1, len(parts) + 1))
+
+    if len(_prefixes_by_name) >= MAX_MEMOIZED_NAMES:
+        _prefixes_by_name.clear()
+
+    _prefixes_by_name[name] = prefixes
+    return prefixes
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError("Context data is read-only, use Context.set()")
+
+
+class ContextData(dict):
+    """A context's data (see Context.data)
+
+    Context data is kept flat by key (see utils.FlatStore), so this is a copy.
+    Rather than let changes to it silently go nowhere, they raise TypeError.
+    """
+    __slots__ = []
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # Copies (and pickles) are ordinary dicts.
+        return dict, (dict(self),)
+
+
+class ContextStack(object):
+    """The active contexts for a thread
+
+    Besides the stack itself, we index contexts by name and by each prefix of
+    their name so we can find parents without searching the whole stack.
+    """
+    __slots__ = ["contexts", "by_name", "by_prefix"]
+
+    def __init__(self):
+        self.contexts = []
+        self.by_name = {}
+
+        # Contexts whose name starts with each prefix (see _name_prefixes()) in
+        # stack order.
+        self.by_prefix = {}
+
+    def push(self, context):
+        if context.name in self.by_name:
+            return
+
+        self.by_name[context.name] = context
+        self.contexts.append(context)
+        for prefix in _name_prefixes(context.name):
+            self.by_prefix.setdefault(prefix, []).append(context)
+
+    def remove(self, context):
+        # Anything we pushed is indexed by name, so this also keeps us from
+        # searching for contexts that have already been removed.
+        if self.by_name.get(context.name) is not context:
+            return
+
+        del self.by_name[context.name]
+
+        # Contexts almost always finish in the reverse order they started.
+        if self.contexts[-1] is context:
+            self.contexts.pop()
+        else:
+            self.contexts.remove(context)
+
+        for prefix in _name_prefixes(context.name):
+            prefix_contexts = self.by_prefix[prefix]
+            if prefix_contexts[-1] is context:
+                prefix_contexts.pop()
+            else:
+                prefix_contexts.remove(context)
+
+            if not prefix_contexts:
+                del self.by_prefix[prefix]
+
+    def clear(self):
+        del self.contexts[:]
+        self.by_name.clear()
+        self.by_prefix.clear()
+
+    def find_closest(self, type_name):
+        """Find the context sharing the most leading name parts with
+        type_name. Ties go to the context started first."""
+        for prefix in reversed(_name_prefixes(type_name)):
+            try:
+                return self.by_prefix[prefix][0]
+            except KeyError:
+                pass
+
+        return None
+
+
+class ThreadStorage(object):
+    """Keeps a ContextStack for each thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = ContextStack()
+            return self.local.stack
+
+
+class GreenletStorage(object):
+    """Keeps a ContextStack for each greenlet, for gevent or eventlet
+
+    The stack is kept as an attribute of the greenlet itself, so it goes away
+    with it (and costs much less to find than a WeakKeyDictionary lookup).
+    Every thread has it's own main greenlet, so code outside of any greenlets
+    still gets a stack for each thread.
+
+    Requires greenlet
+    """
+
+    def __init__(self):
+        if greenlet is None:
+            raise errors.Error("greenlet is not available")
+
+    def get(self):
+        current = greenlet.getcurrent()
+        try:
+            return current._blueox_stack
+        except AttributeError:
+            current._blueox_stack = ContextStack()
+            return current._blueox_stack
+
+
+_storage = ThreadStorage()
+
+
+def set_storage(storage):
+    """Change where we keep our active contexts
+
+    storage.get() returns the ContextStack for whatever is running (see
+    ThreadStorage). Should be done before any contexts are started.
+    """
+    global _storage
+    _storage = storage
+
+
+def _stack():
+    return _storage.get()
 
 
 def init_contexts():
-    if not getattr(threadLocal, 'init', None):
-        threadLocal._contexts = []
-        threadLocal._contexts_by_name = {}
-        threadLocal.init = True
+    _stack()
 
 
 def clear_contexts():
@@ -237,42 +527,24 @@ def clear_contexts():
     handle on. This is useful in testing or anywhere else where you want to be
     absolutely sure you have a clean environment.
     """
-    init_contexts()
-
-    threadLocal._contexts_by_name.clear()
-    del threadLocal._contexts[:]
+    _stack().clear()
 
 
 def _add_context(context):
-    init_contexts()
-
-    if context.name in threadLocal._contexts_by_name:
-        return
-    threadLocal._contexts_by_name[context.name] = context
-    threadLocal._contexts.append(context)
+    _stack().push(context)
 
 
 def _get_context(name):
-    return threadLocal._contexts_by_name.get(str(name))
+    return _stack().by_name.get(str(name))
 
 
 def _remove_context(context):
-    init_contexts()
-    try:
-        del threadLocal._contexts_by_name[context.name]
-    except KeyError:
-        pass
-
-    try:
-        threadLocal._contexts.remove(context)
-    except ValueError:
-        pass
+    _stack().remove(context)
 
 
 def current_context():
-    init_contexts()
     try:
-        ctx = threadLocal._contexts[-1]
+        ctx = _stack().contexts[-1]
         if not ctx.writable:
             # I think this bug is resolved, but for a while there was a rare
             # race condition, I think dealing with signal handlers, that would
@@ -288,54 +560,27 @@ def current_context():
 
 def top_context():
     """Return the outermost context"""
-    init_contexts()
     try:
-        return threadLocal._contexts[0]
+        return _stack().contexts[0]
     except IndexError:
         return None
 
 
-def _calculate_match_length(a_parts, b_parts):
-    length = 0
-    for a, b in zip(a_parts, b_parts):
-        if a != b:
-            break
-        length += 1
-
-    return length
-
-
 def find_closest_context(type_name):
-    init_contexts()
-
-    type_name_parts = type_name.split('.')
-    if not type_name_parts[0]:
+    if not type_name or type_name.startswith('.'):
         raise ValueError(type_name)
 
-    matched_ctx = None
-    matched_ctx_len = 0
-    for ctx in threadLocal._contexts:
-        ctx_parts = ctx.name.split('.')
-
-        shared_part_count = _calculate_match_length(type_name_parts, ctx_parts)
-
-        if matched_ctx_len < shared_part_count:
-            matched_ctx = ctx
-            matched_ctx_len = shared_part_count
-
-    return matched_ctx
+    return _stack().find_closest(type_name)
 
 
 def find_context(type_name):
-    init_contexts()
-
     if type_name == '.':
         return current_context()
     elif type_name == '^':
         return top_context()
     elif type_name == '..':
         try:
-            return threadLocal._contexts[-2]
+            return _stack().contexts[-2]
         except IndexError:
             return None
     else:
@@ -344,19 +589,19 @@ def find_context(type_name):
 
 def set(*args, **kwargs):
     context = current_context()
-    if context:
+    if context is not None and context.enabled:
         context.set(*args, **kwargs)
 
 
 def append(*args, **kwargs):
     context = current_context()
-    if context:
+    if context is not None and context.enabled:
         context.append(*args, **kwargs)
 
 
 def add(*args, **kwargs):
     context = current_context()
-    if context:
+    if context is not None and context.enabled:
         context.add(*args, **kwargs)
 
 
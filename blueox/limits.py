@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+blueox.limits
+~~~~~~~~
+
+This module holds per-type limits on how many events we'll generate. Limits
+are managed centrally by an oxd instance (see oxctl) and periodically
+retrieved by our clients (see network.LimitsPoller). They are checked as each
+context is created.
+
+We also shed load on our own when we can't keep up with sending events (see
+LoadShedder).
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import random
+import time
+
+# Our current limits, by type name
+_limits = {}
+
+# How often we'll reconsider how much load we're shedding.
+SHED_ADJUST_INTERVAL = 1.0
+
+# We never shed more than this ratio of non-root contexts, so there is still
+# some detail around when things recover.
+MIN_KEEP_RATIO = 0.01
+
+# Fill ratios of our send queue that we start shedding at, and that we'll
+# consider drained.
+QUEUE_HIGH_WATER = 0.5
+QUEUE_LOW_WATER = 0.1
+
+
+class TypeLimit(object):
+    """Limit on the events generated for a type
+
+    Arguments:
+    rate -- (optional) ratio of events to sample, like 0.25
+    max_per_sec -- (optional) maximum number of events per second (for this
+        process). Short bursts of up to a second's worth are allowed.
+    """
+
+    def __init__(self, rate=None, max_per_sec=None):
+        self.rate = rate
+        self.max_per_sec = max_per_sec
+
+        self.tokens = max_per_sec
+        self.last_fill = time.time()
+
+    @property
+    def params(self):
+        return (self.rate, self.max_per_sec)
+
+    def allow(self):
+        if self.rate is not None and random.random() >= self.rate:
+            return False
+
+        if self.max_per_sec is not None:
+            now = time.time()
+            self.tokens = min(self.max_per_sec, self.tokens +
+                              (now - self.last_fill) * self.max_per_sec)
+            self.last_fill = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+
+        return True
+
+
+class LoadShedder(object):
+    """Adaptive sampling of non-root contexts when we can't keep up
+
+    The network layer tells us about failed sends and how full its queue is.
+    While either indicates trouble, each adjustment halves the ratio of
+    non-root contexts we keep. Once the backlog has drained we double it
+    again until we're keeping everything.
+
+    Root contexts are never shed, so each request still produces its top level
+    event.
+    """
+
+    def __init__(self):
+        self.keep_ratio = 1.0
+        self.last_adjust = time.time()
+
+        # Counters since the last call to report()
+        self.failures = 0
+        self.total_failures = 0
+        self.shed = {}
+
+    def record_failure(self):
+        self.failures += 1
+
+    def adjust(self, queue_fill, now=None):
+        """Reconsider our keep ratio, if it's been long enough
+
+        queue_fill is the ratio of our send queue in use.
+        """
+        now = now or time.time()
+        if now - self.last_adjust < SHED_ADJUST_INTERVAL:
+            return
+
+        self.last_adjust = now
+
+        if self.failures or queue_fill >= QUEUE_HIGH_WATER:
+            self.keep_ratio = max(MIN_KEEP_RATIO, self.keep_ratio / 2)
+        elif queue_fill <= QUEUE_LOW_WATER and self.keep_ratio < 1.0:
+            self.keep_ratio = min(1.0, self.keep_ratio * 2)
+
+        self.total_failures += self.failures
+        self.failures = 0
+
+    def allow(self, type_name):
+        if self.keep_ratio >= 1.0 or random.random() < self.keep_ratio:
+            return True
+
+        self.shed[type_name] = self.shed.get(type_name, 0) + 1
+        return False
+
+    def report(self):
+        """Return and reset our counters
+
+        Returns None if there is nothing to report.
+        """
+        failures = self.total_failures + self.failures
+        if not failures and not self.shed and self.keep_ratio >= 1.0:
+            return None
+
+        report = {
+            'keep_ratio': self.keep_ratio,
+            'send_failures': failures,
+            'shed': self.shed,
+        }
+
+        self.failures = 0
+        self.total_failures = 0
+        self.shed = {}
+        return report
+
+
+shedder = LoadShedder()
+
+
+def allow(type_name):
+    """Check if an event of the specified type should be generated"""
+    limit = _limits.get(type_name)
+    if limit is None:
+        return True
+
+    return limit.allow()
+
+
+def set_limits(limit_table):
+    """Replace our limits
+
+    The limit table is a dict of type names to a dict of arguments for
+    TypeLimit. Limits that haven't changed keep their current state.
+    """
+    global _limits
+
+    new_limits = {}
+    for type_name, params in limit_table.iteritems():
+        limit = TypeLimit(params.get('rate'), params.get('max_per_sec'))
+
+        existing_limit = _limits.get(type_name)
+        if existing_limit and existing_limit.params == limit.params:
+            limit = existing_limit
+
+        new_limits[type_name] = limit
+
+    _limits = new_limits
+
+
+def clear_limits():
+    set_limits({})
+
+
+def reset_shedder():
+    global shedder
+    shedder = LoadShedder()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+blueox.metrics
+~~~~~~~~
+
+This module provides process-local counters, gauges and timers for
+measurements too frequent to be worth an event each.
+
+They are aggregated in memory and flushed every FLUSH_INTERVAL seconds as a
+single event (of type METRICS_TYPE) through the normal recording path.
+
+    blueox.metrics.incr('cache.hits')
+    blueox.metrics.gauge('pool.size', len(pool))
+    with blueox.metrics.timeit('render'):
+        ...
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import logging
+import os
+import threading
+
+from . import context
+from . import timer
+
+log = logging.getLogger(__name__)
+
+# How often our metrics are flushed.
+FLUSH_INTERVAL = 10.0
+
+METRICS_TYPE = 'blueox.metrics'
+
+# Updates are just a few dict operations, so one (uncontended, mostly) lock is
+# cheap enough.
+_lock = threading.Lock()
+
+# Aggregates since our last flush. Gauges persist between flushes.
+_counters = {}
+_gauges = {}
+_timers = {}
+
+# Our background flusher, started on first use (in each process, as it won't
+# survive a fork).
+_flusher = None
+_flusher_pid = None
+
+
+class FlushThread(threading.Thread):
+    """Thread for periodically flushing our metrics"""
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        super(FlushThread, self).__init__(name="blueox-metrics")
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            try:
+                flush()
+            except Exception:
+                log.exception("Failed to flush metrics")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _start_flusher():
+    global _flusher
+    global _flusher_pid
+
+    pid = os.getpid()
+    with _lock:
+        if _flusher_pid == pid:
+            return
+
+        if _flusher_pid is not None:
+            # We've been forked, so what we have is our parent's to report.
+            _counters.clear()
+            _gauges.clear()
+            _timers.clear()
+
+        _flusher = FlushThread()
+        _flusher.start()
+        _flusher_pid = pid
+
+
+def _reset_lock():
+    global _lock
+    _lock = threading.Lock()
+
+
+# Our lock might have been held by another thread when we were forked.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock)
+
+
+def incr(name, value=1):
+    """Increment a counter"""
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    """Set a gauge to it's current value"""
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+    with _lock:
+        _gauges[name] = value
+
+
+def timing(name, elapsed):
+    """Record an elapsed time (in seconds) for a timer
+
+    Timers are histograms, see timer.update_histogram().
+    """
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+    with _lock:
+        _timers[name] = timer.update_histogram(_timers.get(name), elapsed)
+
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+        self.start_time = timer.clock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        timing(self.name, timer.clock() - self.start_time)
+
+
+def timeit(name):
+    """Context manager for recording the time of some execution to a timer"""
+    return Timer(name)
+
+
+def flush():
+    """Record our aggregated metrics as an event
+
+    Nothing is recorded if nothing has been measured.
+    """
+    global _counters, _timers
+
+    with _lock:
+        counters, _counters = _counters, {}
+        timers, _timers = _timers, {}
+        gauges = dict(_gauges)
+
+    if not (counters or timers or gauges):
+        return
+
+    ctx = context.Context(METRICS_TYPE)
+    with ctx:
+        if counters:
+            ctx.set('counters', counters)
+        if gauges:
+            ctx.set('gauges', gauges)
+        if timers:
+            ctx.set('timers', timers)
+
+
+def reset():
+    """Discard all our metrics"""
+    global _counters, _gauges, _timers
+    with _lock:
+        _counters = {}
+        _gauges = {}
+        _timers = {}
+
+
+def close():
+    """Stop our background flusher, flushing anything outstanding"""
+    global _flusher
+    global _flusher_pid
+
+    if _flusher_pid == os.getpid():
+        _flusher.stop()
+    elif _flusher_pid is not None:
+        # We've been forked, so what we have is our parent's to report.
+        reset()
+
+    _flusher = None
+    _flusher_pid = None
+
+    flush()
@@ -10,26 +10,74 @@ This module provides our interface into ZeroMQ
 
 """
 import logging
+import os
 import threading
 import struct
+import time
 import atexit
+import bisect
+import collections
+import functools
+import Queue
+import zlib
 
 import zmq
 import msgpack
 
 from . import utils
+from . import limits
+from . import ports
+from . import context as _context_mod
 
 log = logging.getLogger(__name__)
 
-# We want to limit how many messages we'll hold in memory so if our oxd is
-# unavailable, we don't just run out of memory.  I based this value on rough
-# value of rather large 3k sized messages, and how many we can fit in 10 megs.
-MAX_QUEUED_MESSAGES = 3500
+# How often we'll retrieve our limits (see blueox.limits) from our control
+# host, and how long we'll wait for it to answer.
+LIMITS_POLL_INTERVAL = 30.0
+LIMITS_TIMEOUT_MSECS = 5000
+
+# We want to limit how much we'll hold in memory so if our oxd is unavailable,
+# we don't just run out of memory. Our events vary in size far too much for a
+# count of messages to mean much, so ZeroMQ only gets a small queue of its own
+# and we hold anything more ourselves (see _send_msg()) up to a budget of
+# bytes.
+MAX_QUEUED_MESSAGES = 250
+MAX_PENDING_BYTES = 10 * 1024 * 1024
+
+# While we're holding messages, the background sender will retry this often
+# even if no new events arrive.
+PENDING_RETRY_INTERVAL = 0.1
+
+# With several collectors, events are routed by hashing their id onto a ring
+# with this many points for each collector (see HashRing).
+RING_POINTS = 100
+
+# If a collector won't take an event, we'll skip it for this long.
+ENDPOINT_BACKOFF = 5.0
+
+# With several collectors, ZeroMQ heartbeats (where supported) let us notice
+# a collector that has stopped answering, so we can route around it.
+HEARTBEAT_IVL_MSECS = 1000
+HEARTBEAT_TIMEOUT_MSECS = 3000
 
 # If we have pending outgoing messages, this is how long we'll wait after
 # being told to exit.
 LINGER_SHUTDOWN_MSECS = 2000
 
+# When sending from a background thread, this is how many finished contexts we
+# will hold waiting to be serialized before we start dropping them.
+MAX_PENDING_CONTEXTS = 3500
+
+# When batching, we'll send what we have once it gets this large or once the
+# oldest event in it has been waiting this long.
+BATCH_MAX_BYTES = 64 * 1024
+BATCH_MAX_DELAY = 0.1
+
+# If we've had to shed or drop anything, we'll send an event of this type
+# describing it (see limits.LoadShedder) this often.
+CLIENT_STATS_TYPE = 'blueox.client'
+CLIENT_STATS_INTERVAL = 60.0
+
 META_STRUCT_FMT = "!Bd64p64p"
 
 # We're going to include a version byte in our meta struct for future
@@ -38,35 +86,555 @@ META_STRUCT_FMT = "!Bd64p64p"
 # hard to ignore.
 META_STRUCT_VERSION = 0x3
 
+# Batches of events get their own version. The meta message is a header
+# followed by a compact header for each event (end time, data length and the
+# type name). The data message is just each event's data, concatenated.  All
+# the events in a batch come from the same process, so share a host.
+META_BATCH_VERSION = 0x4
+BATCH_HEADER_FMT = "!BH64p"
+BATCH_EVENT_FMT = "!dIB"
 
-def check_meta_version(meta):
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER_FMT)
+BATCH_EVENT_SIZE = struct.calcsize(BATCH_EVENT_FMT)
+
+# Our counts and lengths have to fit in the struct
+MAX_BATCH_EVENTS = 0xffff
+
+# Events are packed as a map of id, type, host, pid, start, end and body. We
+# pack the keys (and the host and pid, see _event_envelope()) just once.
+EVENT_MAP_HEADER = msgpack.Packer().pack_map_header(7)
+EVENT_ID_KEY = msgpack.packb('id')
+EVENT_TYPE_KEY = msgpack.packb('type')
+EVENT_START_KEY = msgpack.packb('start')
+EVENT_END_KEY = msgpack.packb('end')
+EVENT_BODY_KEY = msgpack.packb('body')
+
+
+def meta_version(meta):
     value, = struct.unpack(">B", meta[0])
+    return value
+
+
+def check_meta_version(meta):
+    value = meta_version(meta)
     if value != META_STRUCT_VERSION:
         raise ValueError(value)
 
 
+class Batch(object):
+    """Collection of serialized events to be sent as a single message"""
+
+    def __init__(self, host, route_key=None):
+        self.host = host
+        self.route_key = route_key
+        self.headers = []
+        self.data = []
+        self.size = 0
+        self.created = time.time()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def full(self):
+        return self.size >= BATCH_MAX_BYTES or len(self) >= MAX_BATCH_EVENTS
+
+    def add(self, end_time, type_name, context_data):
+        self.headers.append(struct.pack(BATCH_EVENT_FMT, end_time,
+                                        len(context_data), len(type_name)))
+        self.headers.append(type_name)
+        self.data.append(context_data)
+        self.size += len(context_data)
+
+    def event_sizes(self):
+        """List of (type name, data size) for each of our events"""
+        return zip(self.headers[1::2], [len(data) for data in self.data])
+
+    def pack(self):
+        meta_data = struct.pack(BATCH_HEADER_FMT, META_BATCH_VERSION,
+                                len(self), self.host)
+        return meta_data + ''.join(self.headers), ''.join(self.data)
+
+
+def unpack_batch(meta_data, batch_data):
+    """Generate (end time, host, type name, data) for each event in a batch
+
+    The event data is left encoded, so it can be written or passed along as
+    is.
+    """
+    _, count, host = struct.unpack_from(BATCH_HEADER_FMT, meta_data)
+
+    meta_offset = BATCH_HEADER_SIZE
+    data_offset = 0
+    for _ in xrange(count):
+        end_time, data_len, type_len = struct.unpack_from(
+            BATCH_EVENT_FMT, meta_data, meta_offset)
+        meta_offset += BATCH_EVENT_SIZE
+
+        type_name = meta_data[meta_offset:meta_offset + type_len]
+        meta_offset += type_len
+
+        if data_offset + data_len > len(batch_data):
+            raise ValueError("Truncated batch")
+
+        yield (end_time, host, type_name,
+               batch_data[data_offset:data_offset + data_len])
+        data_offset += data_len
+
+
 threadLocal = threading.local()
 
 # Context can be shared between threads
 _zmq_context = None
-_connect_str = None
 
+# Where our collectors are. With more than one, we also have a HashRing.
+_connect_strs = []
+_ring = None
+
+# The process our context and sockets belong to. If we find ourselves in
+# another one (we've been forked), they're rebuilt, see _after_fork().
+_pid = os.getpid()
+
+# Bumped whenever existing sockets should be replaced rather than used (see
+# _connect()), like after a fork or being configured again.
+_generation = 0
+
+# Held while we check for (and recover from) a fork, so only one of our threads
+# does it, see _check_fork().
+_fork_lock = threading.Lock()
+
+# Contexts inherited from our parent process. They can't be safely terminated
+# (or used) in a child, so we hold on to them rather than letting them be
+# garbage collected.
+_orphaned_contexts = []
+
+# Our background sender, if we've been configured to use one.
+_sender = None
+
+# Our limits poller, if we've been configured to use one.
+_limits_poller = None
+
+# The socket all our threads send through, if we've been configured to share
+# one. Otherwise each thread has it's own, in threadLocal.
+_shared_socket = None
+
+# Cached parts of our events, see _event_envelope()
+_envelope = None
+
+# Classes we've failed to encode, so we only complain once.
+_unencodable_classes = set()
+
+# When we last reported our client stats, see _check_load()
+_last_client_stats = time.time()
+
+# Messages we're holding for our collectors, as (meta data, data, size,
+# route key). They're shared between our threads, so whichever sends next
+# (or our background sender) will send them, even if the thread that held
+# them has since exited. Along with their total size in bytes, and the most
+# we'll hold, they're protected by _pending_lock.
+_pending = collections.deque()
+_pending_bytes = 0
+_pending_lock = threading.Lock()
+_max_pending_bytes = MAX_PENDING_BYTES
+
+# What we've dropped since our last report, as a dict of type name to
+# [events, bytes]
+_dropped = {}
+
+
+class SenderThread(threading.Thread):
+    """Thread for serializing and sending contexts off the request path
+
+    Finished contexts are handed to us through a bounded queue. If the queue is
+    full, the context is dropped (and counted) rather than blocking the caller.
+
+    If batch is set, events are coalesced into batch messages (see
+    META_BATCH_VERSION) up to BATCH_MAX_BYTES or BATCH_MAX_DELAY.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_CONTEXTS, batch=False):
+        super(SenderThread, self).__init__(name="blueox-sender")
+        self.daemon = True
+        self.queue = Queue.Queue(max_pending)
+        self.dropped = 0
+        self.batch = batch
+
+    def enqueue(self, context):
+        try:
+            self.queue.put_nowait(context)
+        except Queue.Full:
+            self.dropped += 1
+            limits.shedder.record_failure()
+
+            # We don't know how big it would have been
+            _record_drop(context.name, 0)
+
+    def run(self):
+        if self.batch:
+            self._run_batched()
+        else:
+            while True:
+                try:
+                    context = self.queue.get(timeout=_retry_timeout())
+                except Queue.Empty:
+                    _send_pending()
+                    continue
+
+                if context is None:
+                    break
+
+                _send(context)
+
+        # Closing our socket will linger to deliver anything still pending.
+        _thread_close()
+
+    def _run_batched(self):
+        # With several collectors, we have a batch for each one (see
+        # _primary_endpoint()) so events routed together stay together.
+        batches = {}
+        while True:
+            try:
+                if not batches:
+                    context = self.queue.get(timeout=_retry_timeout())
+                else:
+                    oldest = min(batch.created for batch in batches.values())
+                    timeout = oldest + BATCH_MAX_DELAY - time.time()
+                    context = self.queue.get(timeout=max(timeout, 0))
+            except Queue.Empty:
+                if not batches:
+                    _send_pending()
+
+                expire_time = time.time() - BATCH_MAX_DELAY
+                for endpoint, batch in batches.items():
+                    if batch.created <= expire_time:
+                        _send_batch(batch)
+                        del batches[endpoint]
+                continue
+
+            if context is None:
+                break
+
+            try:
+                end_time, host, type_name, context_data = _serialize_event(
+                    context)
+            except Exception:
+                log.exception("Failed to serialize context")
+                continue
+
+            endpoint = _primary_endpoint(context.id)
+            batch = batches.get(endpoint)
+            if batch is None:
+                batch = batches[endpoint] = Batch(host, context.id)
+
+            batch.add(end_time, type_name, context_data)
+            if batch.full:
+                _send_batch(batch)
+                del batches[endpoint]
+
+        for batch in batches.values():
+            _send_batch(batch)
+
+    def stop(self, timeout=None):
+        """Ask the thread to exit after sending everything already queued"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            log.warning("Sender queue is stuck, abandoning %d contexts",
+                        self.queue.qsize())
+            return
+
+        self.join(timeout)
+
+
+class SharedSocket(object):
+    """Sockets shared by all our threads
+
+    Like threadLocal, we hold zmq_sockets (one for each collector). Our lock
+    must be held to use them, see _with_socket_owner().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.zmq_sockets = None
+
+
+class HashRing(object):
+    """Consistent hashing of event ids onto our collectors
 
-def init(host, port):
+    Events with the same id (the same request) go to the same collector, and
+    adding or removing a collector only moves the events that were (or will be)
+    routed to it. Collectors that won't take an event are marked down for
+    ENDPOINT_BACKOFF, and events routed to them go to the next collector
+    around the ring.
+    """
+
+    def __init__(self, endpoint_count, points=RING_POINTS):
+        self.endpoint_count = endpoint_count
+        self.down_until = [0.0] * endpoint_count
+
+        ring = sorted((_hash("%d-%d" % (endpoint, point)), endpoint)
+                      for endpoint in xrange(endpoint_count)
+                      for point in xrange(points))
+        self.hashes = [hash_value for hash_value, _ in ring]
+        self.endpoints = [endpoint for _, endpoint in ring]
+
+    def primary(self, key):
+        ndx = bisect.bisect(self.hashes, _hash(key)) % len(self.endpoints)
+        return self.endpoints[ndx]
+
+    def route(self, key):
+        """List of collector indexes to try for an event id, in order"""
+        start = bisect.bisect(self.hashes, _hash(key))
+        route = []
+        for endpoint in self.endpoints[start:] + self.endpoints[:start]:
+            if endpoint not in route:
+                route.append(endpoint)
+                if len(route) == self.endpoint_count:
+                    break
+
+        return route
+
+    def is_down(self, endpoint, now):
+        return self.down_until[endpoint] > now
+
+    def mark_down(self, endpoint, now):
+        self.down_until[endpoint] = now + ENDPOINT_BACKOFF
+
+
+def _hash(key):
+    return zlib.crc32(str(key)) & 0xffffffff
+
+
+def _primary_endpoint(key):
+    if _ring is None:
+        return 0
+
+    return _ring.primary(key)
+
+
+class LimitsPoller(threading.Thread):
+    """Thread for periodically retrieving our limits from an oxd control port
+
+    If we fail to retrieve them, we'll keep using the last limits we had.
+    """
+
+    def __init__(self, control_host):
+        super(LimitsPoller, self).__init__(name="blueox-limits")
+        self.daemon = True
+        self.control_host = control_host
+        self.stopped = threading.Event()
+
+    def run(self):
+        zmq_context = zmq.Context()
+        try:
+            while not self.stopped.is_set():
+                self.poll(zmq_context)
+                self.stopped.wait(LIMITS_POLL_INTERVAL)
+        finally:
+            zmq_context.term()
+
+    def poll(self, zmq_context):
+        sock = zmq_context.socket(zmq.REQ)
+        sock.linger = 0
+        try:
+            sock.connect("tcp://%s" % self.control_host)
+            sock.send(msgpack.packb({'cmd': 'LIMITS'}))
+
+            if sock.poll(LIMITS_TIMEOUT_MSECS):
+                response = msgpack.unpackb(sock.recv())
+                if 'limits' in response:
+                    limits.set_limits(response['limits'])
+                else:
+                    log.warning("Failed to retrieve limits from %s: %r",
+                                self.control_host, response)
+            else:
+                log.warning("Timed out retrieving limits from %s",
+                            self.control_host)
+        finally:
+            sock.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def init_limits(control_host):
+    """Start periodically retrieving limits from the specified control host"""
+    global _limits_poller
+
+    _stop_limits_poller()
+
+    _limits_poller = LimitsPoller(control_host)
+    _limits_poller.start()
+
+
+def _stop_limits_poller():
+    global _limits_poller
+
+    if _limits_poller is not None:
+        _limits_poller.stop()
+        _limits_poller = None
+
+
+def init(host, port, threaded=False, batch=False,
+         max_pending_bytes=MAX_PENDING_BYTES, shared=False):
+    """Setup our network connection to the collector
+
+    If threaded is set, events are serialized and sent from a background
+    thread. Setting batch implies threaded, and coalesces events into batch
+    messages which require a collector that understands META_BATCH_VERSION.
+
+    max_pending_bytes is how much we'll hold waiting for our collector before
+    we start dropping events.
+
+    If shared is set, all our threads send through a single socket rather
+    than each having their own.
+
+    host may also be an 'ipc://' endpoint, or a list of 'hostname:port' (or
+    ipc) endpoints, in which case port should be None. Events are spread over
+    a list of collectors by their id, see HashRing.
+    """
     global _zmq_context
-    global _connect_str
+    global _connect_strs
+    global _ring
+    global _sender
+    global _max_pending_bytes
+    global _shared_socket
+    global _generation
+
+    _stop_sender()
+    _close_shared_socket()
+
+    _max_pending_bytes = max_pending_bytes
+    _generation += 1
 
     _zmq_context = zmq.Context()
-    _connect_str = "tcp://%s:%d" % (host, port)
+    if isinstance(host, (list, tuple)):
+        endpoints = host
+    elif port is None:
+        endpoints = [host]
+    else:
+        endpoints = ["%s:%d" % (host, port)]
+
+    _connect_strs = [ports.collect_connect_str(endpoint)
+                     for endpoint in endpoints]
+    _ring = HashRing(len(_connect_strs)) if len(_connect_strs) > 1 else None
+
+    if shared:
+        _shared_socket = SharedSocket()
+
+    if threaded or batch:
+        _sender = SenderThread(batch=batch)
+        _sender.start()
+
+
+def _with_socket_owner(func):
+    """Call func with whatever holds the socket this thread should send with
+
+    That's our SharedSocket (with it's lock held) if we have one, otherwise
+    threadLocal.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        shared_socket = _shared_socket
+        if shared_socket is None:
+            return func(threadLocal, *args)
+
+        with shared_socket.lock:
+            return func(shared_socket, *args)
 
+    return wrapper
 
-def _thread_connect():
-    if _zmq_context and not getattr(threadLocal, 'zmq_socket', None):
-        threadLocal.zmq_socket = _zmq_context.socket(zmq.PUSH)
-        threadLocal.zmq_socket.hwm = MAX_QUEUED_MESSAGES
-        threadLocal.zmq_socket.linger = LINGER_SHUTDOWN_MSECS
 
-        threadLocal.zmq_socket.connect(_connect_str)
+def _connect(owner):
+    if not _zmq_context:
+        return
+
+    if (getattr(owner, 'zmq_sockets', None) and
+            owner.generation != _generation):
+        _close_socket(owner)
+
+    if not getattr(owner, 'zmq_sockets', None):
+        owner.zmq_sockets = []
+        for connect_str in _connect_strs:
+            zmq_socket = _zmq_context.socket(zmq.PUSH)
+            zmq_socket.hwm = MAX_QUEUED_MESSAGES
+            zmq_socket.linger = LINGER_SHUTDOWN_MSECS
+
+            if _ring is not None:
+                # We'd rather fail over than queue for a collector we aren't
+                # connected to.
+                zmq_socket.immediate = 1
+                if zmq.zmq_version_info() >= (4, 2):
+                    zmq_socket.heartbeat_ivl = HEARTBEAT_IVL_MSECS
+                    zmq_socket.heartbeat_timeout = HEARTBEAT_TIMEOUT_MSECS
+
+            zmq_socket.connect(connect_str)
+            owner.zmq_sockets.append(zmq_socket)
+
+        owner.generation = _generation
+        owner.pid = _pid
+
+
+def _reset_locks():
+    """Replace any locks some other thread might have held when we forked"""
+    global _pending_lock
+    global _fork_lock
+    global _shared_socket
+
+    _pending_lock = threading.Lock()
+    _fork_lock = threading.Lock()
+    if _shared_socket is not None:
+        _shared_socket = SharedSocket()
+
+
+def _after_fork():
+    """Rebuild our context and threads in a newly forked child
+
+    Sockets are replaced as each thread next sends. Anything we were holding
+    to send was our parent's to deal with.
+    """
+    global _pid
+    global _zmq_context
+    global _generation
+    global _pending
+    global _pending_bytes
+    global _sender
+    global _limits_poller
+
+    _pid = os.getpid()
+    _reset_locks()
+
+    _generation += 1
+    _pending = collections.deque()
+    _pending_bytes = 0
+
+    if _zmq_context is not None:
+        _orphaned_contexts.append(_zmq_context)
+        _zmq_context = zmq.Context()
+
+    # Threads don't survive a fork
+    if _sender is not None:
+        _sender = SenderThread(batch=_sender.batch)
+        _sender.start()
+
+    if _limits_poller is not None:
+        _limits_poller = LimitsPoller(_limits_poller.control_host)
+        _limits_poller.start()
+
+
+def _check_fork():
+    """Rebuild things if we've been forked since we last looked"""
+    if _pid != os.getpid():
+        with _fork_lock:
+            # Another thread may have already done it.
+            if _pid != os.getpid():
+                _after_fork()
+
+
+# We notice a fork when we next send (see send()), but any locks need replacing
+# before then.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_locks)
 
 
 def _serialize_context(context):
@@ -75,60 +643,379 @@ def _serialize_context(context):
     # use for routing and stats. This is much faster than having the
     # collector decode the whole event. We're just going to use python
     # struct module to make a quick and dirty data structure
-    context_dict = context.to_dict()
-    for key in ('host', 'type'):
-        if len(context_dict.get(key, "")) > 64:
-            raise ValueError("Value too long: %r" % key)
+    end_time, host, type_name, context_data = _serialize_event(context)
+
+    meta_data = struct.pack(META_STRUCT_FMT, META_STRUCT_VERSION, end_time,
+                            host, type_name)
+
+    return meta_data, context_data
+
+
+def _event_envelope():
+    """Retrieve the parts of our events that only change between processes
+
+    Returns a tuple of (pid, host, packed envelope fields). This is rebuilt if
+    we notice our pid has changed, such as after a fork.
+    """
+    global _envelope
+
+    pid = os.getpid()
+    if _envelope is None or _envelope[0] != pid:
+        host = os.uname()[1]
+        packed = ''.join(msgpack.packb(value)
+                         for value in ('host', host, 'pid', pid))
+        _envelope = (pid, host, packed)
 
-    meta_data = struct.pack(META_STRUCT_FMT, META_STRUCT_VERSION,
-                            context_dict['end'], context_dict['host'],
-                            context_dict['type'])
+    return _envelope
 
+
+def _encode_default(obj):
+    """Encode values msgpack doesn't know about
+
+    Values we can't find an encoder for (or that fail to encode) are dropped,
+    leaving the rest of the event alone.
+    """
     try:
-        context_data = msgpack.packb(context_dict)
-    except TypeError:
-        try:
-            # If we fail to serialize our context, we can try again with an
-            # enhanced packer (it's slower though)
-            context_data = msgpack.packb(context_dict,
-                                         default=utils.msgpack_encode_default)
-        except TypeError:
-            log.exception("Serialization failure (not fatal, dropping data)")
+        return utils.msgpack_encode_default(obj)
+    except Exception:
+        if obj.__class__ not in _unencodable_classes:
+            _unencodable_classes.add(obj.__class__)
+            log.exception("Serialization failure for %r (not fatal, "
+                          "dropping value)", obj.__class__)
 
-            # One last try after dropping the body
-            context_dict['body'] = None
-            context_data = msgpack.packb(context_dict)
+        return None
 
-    return meta_data, context_data
+
+def _thread_packer():
+    # Packers keep some state, so can't be shared between threads.
+    packer = getattr(threadLocal, 'packer', None)
+    if packer is None:
+        packer = threadLocal.packer = msgpack.Packer(default=_encode_default)
+
+    return packer
+
+
+def _pack_body(packer, store):
+    """Pack a context's data (a utils.FlatStore) as it's nested dict"""
+    try:
+        return packer.pack(store.tree)
+    except Exception:
+        log.exception("Serialization failure (not fatal, dropping data)")
+
+        # A failed pack leaves junk in the packer's buffer
+        packer.reset()
+        return packer.pack(None)
+
+
+def _serialize_event(context):
+    """Serialize a context into the data needed for our meta struct, and the
+    encoded event itself.
+
+    Rather than building a dict (see Context.to_dict()) and packing it, we
+    pack each field directly, re-using the packed envelope fields that are the
+    same for every event.
+
+    Returns a tuple of (end time, host, type name, event data)
+    """
+    _, host, envelope = _event_envelope()
+
+    type_name = context.name
+    if len(host) > 64:
+        raise ValueError("Value too long: 'host'")
+    if len(type_name) > 64:
+        raise ValueError("Value too long: 'type'")
+
+    end_time = context.end_time or time.time()
+
+    packer = _thread_packer()
+    context_data = ''.join((EVENT_MAP_HEADER,
+                            envelope,
+                            EVENT_ID_KEY,
+                            packer.pack(context.id),
+                            EVENT_TYPE_KEY,
+                            packer.pack(type_name),
+                            EVENT_START_KEY,
+                            packer.pack(context.start_time),
+                            EVENT_END_KEY,
+                            packer.pack(end_time),
+                            EVENT_BODY_KEY,
+                            _pack_body(packer, context._data)))
+
+    return end_time, host, type_name, context_data
 
 
 def send(context):
-    global _zmq_context
-    _thread_connect()
+    _check_fork()
+
+    if _sender is not None:
+        _sender.enqueue(context)
+    else:
+        _send(context)
+
+    _check_load()
+
+
+def _queue_fill():
+    """How full the worse of our sender's queue and our pending messages are"""
+    pending_fill = _pending_bytes / float(_max_pending_bytes or 1)
+    if _sender is None:
+        return pending_fill
+
+    return max(pending_fill,
+               _sender.queue.qsize() / float(_sender.queue.maxsize))
+
+
+def _check_load(now=None):
+    """Let our load shedder adjust, and periodically report what it's done"""
+    global _last_client_stats
+    now = now or time.time()
+    shedder = limits.shedder
 
+    if now - shedder.last_adjust >= limits.SHED_ADJUST_INTERVAL:
+        keep_ratio = shedder.keep_ratio
+        shedder.adjust(_queue_fill(), now)
+        if shedder.keep_ratio != keep_ratio:
+            log.warning("Send backlog, keeping %.2f of contexts",
+                        shedder.keep_ratio)
+
+    if now - _last_client_stats >= CLIENT_STATS_INTERVAL:
+        _last_client_stats = now
+        report = shedder.report() or {}
+
+        dropped = _pop_dropped()
+        if dropped:
+            report['dropped'] = dropped
+
+        if report:
+            _send_client_stats(report)
+
+
+def _send_client_stats(report):
+    ctx = _context_mod.Context(CLIENT_STATS_TYPE)
+    with ctx:
+        for key, value in report.iteritems():
+            ctx.set(key, value)
+
+
+def _send(context):
     try:
         meta_data, context_data = _serialize_context(context)
     except Exception:
         log.exception("Failed to serialize context")
         return
 
-    if _zmq_context and threadLocal.zmq_socket is not None:
-        try:
+    event_sizes = [(context.name, len(context_data))]
+    if not _send_msg(meta_data, context_data, event_sizes, context.id):
+        log.info("Skipping sending event %s", context.name)
+
+
+def _send_batch(batch):
+    meta_data, batch_data = batch.pack()
+    if not _send_msg(meta_data, batch_data, batch.event_sizes(),
+                     batch.route_key):
+        log.info("Skipping sending batch of %d events", len(batch))
+
+
+@_with_socket_owner
+def _send_msg(owner, meta_data, data, event_sizes, route_key):
+    """Send a message to our collector
+
+    If our socket won't take the message right now, we'll hold on to it (see
+    _hold_msg()). event_sizes is a list of (type name, data size) of the events
+    in the message, for accounting for anything we drop. The route_key (an
+    event id) picks the collector, if we have several.
+
+    Returns False if we aren't connected to one.
+    """
+    _connect(owner)
+
+    if _zmq_context and owner.zmq_sockets:
+        if _pending:
+            _drain_pending(owner)
+
+        # Anything already held goes first.
+        if not _pending:
             log.debug("Sending msg")
-            threadLocal.zmq_socket.send_multipart(
-                (meta_data, context_data), zmq.NOBLOCK)
-        except zmq.ZMQError, e:
-            log.exception("Failed sending blueox event, buffer full?")
+            if _try_send(owner, meta_data, data, route_key):
+                return True
+
+        # Logging every failure would only add to our troubles, so we leave it
+        # to our load shedder to report on them.
+        limits.shedder.record_failure()
+
+        _hold_msg(meta_data, data, event_sizes, route_key)
+        return True
     else:
-        log.info("Skipping sending event %s", context.name)
+        return False
+
+
+def _try_send(owner, meta_data, data, route_key):
+    """Hand a message to one of our sockets, without waiting
+
+    Returns False if none of them will take it.
+    """
+    if _ring is None:
+        try:
+            owner.zmq_sockets[0].send_multipart((meta_data, data),
+                                                zmq.NOBLOCK)
+            return True
+        except zmq.ZMQError:
+            return False
+
+    now = time.time()
+    for endpoint in _ring.route(route_key):
+        if _ring.is_down(endpoint, now):
+            continue
+
+        try:
+            owner.zmq_sockets[endpoint].send_multipart((meta_data, data),
+                                                       zmq.NOBLOCK)
+            return True
+        except zmq.ZMQError:
+            _ring.mark_down(endpoint, now)
+
+    return False
+
+
+def _hold_msg(meta_data, data, event_sizes, route_key):
+    """Hold a message to send later, if we have room for it"""
+    global _pending_bytes
+
+    size = len(meta_data) + len(data)
+    with _pending_lock:
+        if _pending_bytes + size > _max_pending_bytes:
+            for type_name, event_size in event_sizes:
+                _record_drop(type_name, event_size)
+            return
+
+        _pending_bytes += size
+        _pending.append((meta_data, data, size, route_key))
+
+
+def _drain_pending(owner):
+    """Send as many of our held messages as the owner's sockets will take"""
+    global _pending_bytes
+
+    if not getattr(owner, 'zmq_sockets', None):
+        return
+
+    # Our sends don't wait, so we can hold the lock to keep the order.
+    with _pending_lock:
+        while _pending:
+            meta_data, data, size, route_key = _pending[0]
+            if not _try_send(owner, meta_data, data, route_key):
+                break
+
+            _pending.popleft()
+            _pending_bytes -= size
+
+
+@_with_socket_owner
+def _send_pending(owner):
+    _connect(owner)
+    _drain_pending(owner)
+
+
+def _retry_timeout():
+    """How long our background sender should wait for new events"""
+    if _pending:
+        return PENDING_RETRY_INTERVAL
+
+    return None
+
+
+def _record_drop(type_name, size):
+    # We don't bother with a lock, an occasional miscount is fine for a report.
+    counts = _dropped.get(type_name)
+    if counts is None:
+        counts = _dropped[type_name] = [0, 0]
+
+    counts[0] += 1
+    counts[1] += size
+
+
+def _pop_dropped():
+    """Return and reset our dropped counts
+
+    Returns a dict of type name to a dict of events and bytes.
+    """
+    global _dropped
+    dropped, _dropped = _dropped, {}
+
+    return dict((type_name, {'events': events, 'bytes': size})
+                for type_name, (events, size) in dropped.iteritems())
+
+
+def stats():
+    """Counters describing the state of our sending"""
+    counters = {'queue_depth': 0,
+                'dropped': 0,
+                'pending_bytes': _pending_bytes}
+    if _sender is not None:
+        counters['queue_depth'] = _sender.queue.qsize()
+        counters['dropped'] = _sender.dropped
+
+    return counters
+
+
+def _stop_sender():
+    global _sender
+
+    if _sender is not None:
+        _sender.stop(LINGER_SHUTDOWN_MSECS / 1000.0)
+        _sender = None
+
+
+def _close_socket(owner):
+    if not getattr(owner, 'zmq_sockets', None):
+        return
+
+    if owner.pid != _pid:
+        # Our parent's sockets, which we can't safely touch.
+        owner.zmq_sockets = None
+    else:
+        # One last chance to hand ZeroMQ what we're holding. Anything left is
+        # for our other sockets, see _drop_pending().
+        _drain_pending(owner)
+
+        for zmq_socket in owner.zmq_sockets:
+            zmq_socket.close()
+        owner.zmq_sockets = None
+
+
+def _drop_pending():
+    """Give up on anything we're still holding"""
+    global _pending_bytes
+
+    with _pending_lock:
+        _pending.clear()
+        _pending_bytes = 0
+
+
+def _thread_close():
+    _close_socket(threadLocal)
+
+
+def _close_shared_socket():
+    global _shared_socket
+
+    if _shared_socket is not None:
+        with _shared_socket.lock:
+            _close_socket(_shared_socket)
+        _shared_socket = None
 
 
 def close():
     global _zmq_context
 
-    if getattr(threadLocal, 'zmq_socket', None):
-        threadLocal.zmq_socket.close()
-        threadLocal.zmq_socket = None
+    _check_fork()
+
+    # Flush our background sender first, it needs the context to be around.
+    _stop_sender()
+    _stop_limits_poller()
+    _thread_close()
+    _close_shared_socket()
+    _drop_pending()
 
     _zmq_context = None
 
@@ -13,14 +13,26 @@ ports, which we'd like to abstract from the user as much as possible.
 
 """
 import os
+import socket
+import stat
 
 ENV_VAR_CONTROL_HOST = 'BLUEOX_CLIENT_HOST'
 ENV_VAR_COLLECT_HOST = 'BLUEOX_HOST'
+ENV_VAR_LIMITS_HOST = 'BLUEOX_LIMITS_HOST'
+ENV_VAR_IPC_DIR = 'BLUEOX_IPC_DIR'
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_CONTROL_PORT = 3513
 DEFAULT_COLLECT_PORT = 3514
 
+# A local oxd also listens for collection on a unix domain socket, so clients
+# on the same host can skip the TCP stack (see collect_connect_str()). This
+# lives in a directory oxd creates, not somewhere anyone could put a socket
+# for our clients to find.
+DEFAULT_IPC_DIR = '/var/run/blueox'
+IPC_FILE_FMT = 'collect-{}.sock'
+LOCAL_HOSTS = ('127.0.0.1', 'localhost')
+
 
 def _default_host(host, default_host, default_port):
     """Build a default host string
@@ -39,5 +51,83 @@ def default_control_host(host=None):
 
 
 def default_collect_host(host=None):
+    """Build the collect host string
+
+    This may be a comma separated list of hosts, each of which gets the
+    default port if it doesn't have one.
+    """
     default_host = os.environ.get(ENV_VAR_COLLECT_HOST, DEFAULT_HOST)
-    return _default_host(host, default_host, DEFAULT_COLLECT_PORT)
+    hosts = (host or default_host).split(',')
+    return ','.join(_default_host(host, default_host, DEFAULT_COLLECT_PORT)
+                    for host in hosts)
+
+
+def default_limits_host(host=None):
+    """Build the control host we should retrieve limits from
+
+    Unlike our other hosts, there is no default. If no host is provided and
+    the environment variable isn't set, returns None.
+    """
+    host = host or os.environ.get(ENV_VAR_LIMITS_HOST)
+    if not host:
+        return None
+
+    return _default_host(host, DEFAULT_HOST, DEFAULT_CONTROL_PORT)
+
+
+def is_ipc(host):
+    return host.startswith('ipc://')
+
+
+def default_ipc_dir():
+    return os.environ.get(ENV_VAR_IPC_DIR, DEFAULT_IPC_DIR)
+
+
+def default_ipc_path(port):
+    return os.path.join(default_ipc_dir(), IPC_FILE_FMT.format(port))
+
+
+def is_listening(path):
+    """Check there's something we can send to at a unix domain socket path
+
+    ZeroMQ will happily connect to a socket we don't have permission to use,
+    or that nothing is listening on any more, and keep retrying without
+    telling anyone. So before we use one, we make sure it's a socket we can
+    write to and actually connect to.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+
+    if not stat.S_ISSOCK(mode) or not os.access(path, os.W_OK):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def collect_connect_str(host):
+    """Build the ZeroMQ endpoint to connect to for a collect host
+
+    The host is either 'hostname:port' or an 'ipc://' endpoint. If the host is
+    local and there is an oxd listening at the default ipc path for the port
+    (see is_listening()), we'll connect to that rather than using TCP.
+    """
+    if is_ipc(host):
+        return host
+
+    hostname, port = host.split(':')
+    if hostname in LOCAL_HOSTS:
+        path = default_ipc_path(port)
+        if is_listening(path):
+            return "ipc://" + path
+
+    return "tcp://" + host
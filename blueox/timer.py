@@ -4,28 +4,163 @@ blueox.timer
 ~~~~~~~~
 
 This module has a timer context manager for easily tracking wall-clock time for some execution
+
+Timing the same key repeatedly can accumulate a histogram rather than just
+keeping the last time (see update_histogram()).
+
 :copyright: (c) 2012 by Rhett Garber
 :license: ISC, see LICENSE for more details.
 
 """
+import math
+import sys
 import time
 
 from . import context
 
+# clock_gettime() ids for a monotonic clock, by platform
+CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6}
+
+
+def _monotonic_clock():
+    """Build a monotonic clock from clock_gettime(), for python 2
+
+    Returns None if it isn't available.
+    """
+    clock_id = CLOCK_MONOTONIC.get(sys.platform.rstrip('0123456789'))
+    if clock_id is None:
+        return None
+
+    try:
+        import ctypes
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL(None).clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+            return time.time()
+
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+        return None
+
+    return monotonic
+
+
+# Python 3.3+ has a monotonic high resolution clock. Otherwise we use
+# clock_gettime() if we can, and make do with wall-clock time if we can't.
+clock = (getattr(time, 'perf_counter', None) or _monotonic_clock() or
+         time.time)
+
+# CPU time used by our process (time.clock is CPU time on unix for python 2)
+cpu_clock = getattr(time, 'process_time', None) or time.clock
+
+# Histograms have log2 buckets. The first is everything under
+# HISTOGRAM_MIN_TIME, and each after that is twice as wide as the last, with
+# the final one holding everything left (HISTOGRAM_MIN_TIME * 2 ** 18, about
+# 26 seconds, or more).
+HISTOGRAM_MIN_TIME = 0.0001
+HISTOGRAM_BUCKETS = 20
+
+
+def histogram_bucket(elapsed):
+    if elapsed < HISTOGRAM_MIN_TIME:
+        return 0
+
+    return min(HISTOGRAM_BUCKETS - 1,
+               int(math.log(elapsed / HISTOGRAM_MIN_TIME, 2)) + 1)
+
+
+def update_histogram(histogram, elapsed):
+    """Add a time to a histogram, returning it
+
+    Histograms are dicts of count, sum, min and max, along with a fixed size
+    list of counts for each bucket. Pass None to start a new one.
+    """
+    if histogram is None:
+        histogram = {
+            'count': 0,
+            'sum': 0.0,
+            'min': elapsed,
+            'max': elapsed,
+            'buckets': [0] * HISTOGRAM_BUCKETS,
+        }
+
+    histogram['count'] += 1
+    histogram['sum'] += elapsed
+    if elapsed < histogram['min']:
+        histogram['min'] = elapsed
+    if elapsed > histogram['max']:
+        histogram['max'] = elapsed
+    histogram['buckets'][histogram_bucket(elapsed)] += 1
+
+    return histogram
+
 
 class Timer(object):
+    """Records the time taken to the key in a context
+
+    If cpu is set, the CPU time used is also recorded to '<key>_cpu'.
+    """
 
-    def __init__(self, context, key):
+    def __init__(self, context, key, histogram=False, cpu=False):
         self.context = context
         self.key = key
-        self.start_time = time.time()
+        self.histogram = histogram
+        self.cpu = cpu
+        self.start_time = clock()
+        if cpu:
+            self.start_cpu_time = cpu_clock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.record(self.key, clock() - self.start_time)
+        if self.cpu:
+            self.record(self.key + '_cpu', cpu_clock() - self.start_cpu_time)
+
+    def record(self, key, elapsed):
+        if self.histogram:
+            histogram = self.context.get(key)
+            if not isinstance(histogram, dict):
+                histogram = None
+
+            self.context.set(key, update_histogram(histogram, elapsed))
+        else:
+            self.context.set(key, elapsed)
+
+
+class NullTimer(object):
+    """Timer for when there is nothing to record the time to"""
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        self.context.set(self.key, time.time() - self.start_time)
+        pass
+
+
+_null_timer = NullTimer()
+
+
+def timeit(key, histogram=False, cpu=False):
+    """Time some execution, recording it to key in the current context
 
+    If histogram is set, repeated timings of the key are accumulated into a
+    histogram (see update_histogram()) rather than replacing each other.
+    """
+    ctx = context.current_context()
+    if ctx is None or not ctx.enabled:
+        return _null_timer
 
-def timeit(key):
-    return Timer(context.current_context(), key)
+    return Timer(ctx, key, histogram=histogram, cpu=cpu)
@@ -13,6 +13,7 @@ tornado.
 
 """
 import functools
+import inspect
 import logging
 import traceback
 import types
@@ -67,6 +68,10 @@ def coroutine(func):
     If you don't use this wrapper, unrelated contexts may be grouped together!
     """
 
+    # Calling a generator function doesn't run any of it, so there's no need
+    # to switch contexts until _gen_wrapper resumes it.
+    is_generator = inspect.isgeneratorfunction(func)
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
@@ -76,15 +81,14 @@ def coroutine(func):
 
         # Remember, not every coroutine wrapped method will return a generator,
         # so we have to manage context switching in multiple places.
-        if ctx is not None:
+        if ctx is not None and not is_generator:
             ctx.start()
-
-        result = func(*args, **kwargs)
-
-        if ctx is not None:
+            result = func(*args, **kwargs)
             ctx.stop()
+        else:
+            result = func(*args, **kwargs)
 
-        if isinstance(result, types.GeneratorType):
+        if ctx is not None and isinstance(result, types.GeneratorType):
             return _gen_wrapper(ctx, result)
 
         return result
@@ -160,7 +164,7 @@ class AsyncHTTPClient(tornado.simple_httpclient.SimpleAsyncHTTPClient):
 
         # I'd love to use the future to handle the completion step, BUT, we
         # need this to happen first. If the caller has provided a callback, we don't want them
-        # to get called before we do. Rather than poke into the internal datastructures, we'll just 
+        # to get called before we do. Rather than poke into the internal datastructures, we'll just
         # handle the callback explicitly
 
         def complete_context(response):
@@ -9,6 +9,7 @@ This module provides utility functions that are used within BlueOx
 :license: ISC, see LICENSE for more details.
 
 """
+import collections
 import datetime
 import decimal
 import time
@@ -71,16 +72,213 @@ def set_deep(target, key, value):
     iter_value[p_key[-1]] = value
 
 
+# How many compiled keys we'll remember. Keys are almost always literals in
+# application code so we shouldn't see many, but we don't want to grow without
+# bound if someone is generating them.
+MAX_COMPILED_KEYS = 4096
+
+_compiled_keys = {}
+
+
+def compile_key(key):
+    """Parse a key into the parts needed by FlatStore
+
+    Returns a tuple of (canonical key, key elements, ancestor keys, invalid
+    index) where invalid index is an integer element that prevents the key
+    from being set (see set_deep()), or None.
+    """
+    try:
+        return _compiled_keys[key]
+    except KeyError:
+        pass
+
+    p_key = parse_key(key)
+    elems = tuple(p_key)
+    ancestors = tuple(str(p_key[:ndx]) for ndx in range(1, len(elems)))
+
+    invalid_index = None
+    for elem in elems[:-1]:
+        if isinstance(elem, int):
+            invalid_index = elem
+            break
+
+    if len(_compiled_keys) >= MAX_COMPILED_KEYS:
+        _compiled_keys.clear()
+
+    compiled = (str(p_key), elems, ancestors, invalid_index)
+    _compiled_keys[key] = compiled
+    return compiled
+
+
+class FlatStore(object):
+    """Storage for values set by dotted keys
+
+    Rather than finding our way through a nested dict by key each time (see
+    get_deep() and set_deep()), values are stored flat by their key. Setting a
+    key replaces anything stored below it, and setting a key below a stored
+    value sets it inside that value, so we never store both a key and one of
+    it's ancestors.
+    """
+    __slots__ = ["values", "prefixes", "tree"]
+
+    def __init__(self):
+        self.values = {}
+
+        # Count of stored keys below each ancestor key
+        self.prefixes = {}
+
+        # The same values nested by key, kept up to date as they're set so
+        # they can be serialized without building it then. Unlike to_dict(),
+        # this is ours, not to be changed.
+        self.tree = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key, default=None):
+        c_key, elems, ancestors, _ = compile_key(key)
+        try:
+            return self.values[c_key]
+        except KeyError:
+            pass
+
+        for ndx, ancestor in enumerate(ancestors):
+            if ancestor in self.values:
+                value = self.values[ancestor]
+                for elem in elems[ndx + 1:]:
+                    try:
+                        value = value[elem]
+                    except (KeyError, IndexError):
+                        return default
+
+                return value
+
+        if c_key in self.prefixes:
+            return get_deep(self.to_dict(), c_key, default)
+
+        return default
+
+    def set(self, key, value):
+        c_key, elems, ancestors, invalid_index = compile_key(key)
+        if c_key in self.values:
+            self.values[c_key] = value
+            if len(elems) == 1:
+                self.tree[c_key] = value
+            else:
+                self._set_tree(elems, value)
+            return
+
+        if invalid_index is not None:
+            raise ValueError(invalid_index)
+
+        for ndx, ancestor in enumerate(ancestors):
+            if ancestor in self.values:
+                target = self.values[ancestor]
+                for elem in elems[ndx + 1:-1]:
+                    target = target.setdefault(elem, {})
+
+                target[elems[-1]] = value
+                return
+
+        if c_key in self.prefixes:
+            self._remove_below(c_key)
+
+        self.values[c_key] = value
+        for ancestor in ancestors:
+            self.prefixes[ancestor] = self.prefixes.get(ancestor, 0) + 1
+
+        # This also replaces anything we had below the key.
+        self._set_tree(elems, value)
+
+    def _set_tree(self, elems, value):
+        if len(elems) == 1:
+            self.tree[elems[0]] = value
+        elif len(elems) == 2:
+            # By far the most common nested key
+            self.tree.setdefault(elems[0], {})[elems[1]] = value
+        else:
+            target = self.tree
+            for elem in elems[:-1]:
+                target = target.setdefault(elem, {})
+
+            target[elems[-1]] = value
+
+    def _remove_below(self, c_key):
+        prefix = c_key + '.'
+        for key in [k for k in self.values if k.startswith(prefix)]:
+            del self.values[key]
+            for ancestor in compile_key(key)[2]:
+                self.prefixes[ancestor] -= 1
+                if not self.prefixes[ancestor]:
+                    del self.prefixes[ancestor]
+
+    def to_dict(self):
+        result = {}
+        for c_key, value in self.values.iteritems():
+            elems = compile_key(c_key)[1]
+
+            target = result
+            for elem in elems[:-1]:
+                target = target.setdefault(elem, {})
+
+            target[elems[-1]] = value
+
+        return result
+
+
+# Functions for encoding types msgpack doesn't know about, as (type, encoder)
+# pairs. See register_encoder()
+_encoders = []
+
+# Encoders we've already found for a class (or None if there isn't one)
+_encoders_by_class = {}
+
+
+def register_encoder(type_, encoder):
+    """Register a function for encoding values of type_ into msgpack
+
+    The encoder is given the value and should return something msgpack knows
+    how to serialize. Encoders also apply to sub-classes of type_, and the most
+    recently registered encoder wins.
+    """
+    _encoders.append((type_, encoder))
+    _encoders_by_class.clear()
+
+
+def find_encoder(cls):
+    """Find the registered encoder for the specified class, or None"""
+    try:
+        return _encoders_by_class[cls]
+    except KeyError:
+        pass
+
+    encoder = None
+    for type_, type_encoder in reversed(_encoders):
+        if issubclass(cls, type_):
+            encoder = type_encoder
+            break
+
+    _encoders_by_class[cls] = encoder
+    return encoder
+
+
 def msgpack_encode_default(obj):
     """Extra encodings for python types into msgpack
 
-    These are attempted if our normal serialization fails.
+    These are attempted if our normal serialization fails. See
+    register_encoder()
     """
-    if isinstance(obj, decimal.Decimal):
-        return str(obj)
-    if isinstance(obj, datetime.datetime):
-        return time.mktime(obj.utctimetuple())
-    if isinstance(obj, datetime.date):
-        return obj.strftime("%Y-%m-%d")
-
-    raise TypeError("Unknown type: %r" % (obj,))
+    encoder = find_encoder(obj.__class__)
+    if encoder is None:
+        raise TypeError("Unknown type: %r" % (obj,))
+
+    return encoder(obj)
+
+
+register_encoder(decimal.Decimal, str)
+register_encoder(datetime.date, lambda obj: obj.strftime("%Y-%m-%d"))
+register_encoder(datetime.datetime,
+                 lambda obj: time.mktime(obj.utctimetuple()))
+
+# Things like tornado's HTTPHeaders
+register_encoder(collections.Mapping, dict)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+blueox.workers
+~~~~~~~~
+
+This module carries the current context into work run by thread or process
+pools, which otherwise can't see it.
+
+    pool = blueox.executor(ThreadPoolExecutor(8))
+    with blueox.Context('request'):
+        results = list(pool.map(fetch, urls))
+
+Each task runs in a child context (named like 'request.task') with the same
+id as the context it was submitted from. The child records how long the task
+waited in the pool's queue and how long it ran. For thread pools these times
+are also accumulated into the submitting context as histograms (see
+timer.update_histogram()) under 'tasks.queue_time' and 'tasks.run_time'.
+
+:copyright: (c) 2015 by Rhett Garber
+:license: ISC, see LICENSE for more details.
+
+"""
+import logging
+import threading
+import time
+
+from . import context
+from . import timer
+
+log = logging.getLogger(__name__)
+
+# Tasks may finish in several threads at once, and a context's data isn't
+# safe to update concurrently.
+_lock = threading.Lock()
+
+
+class Task(object):
+    """Callable running a function in a child of the current context
+
+    Tasks can be pickled (if their function can be) to run in another process.
+    Only what's needed to name the child context goes along, so times are only
+    accumulated into the parent context when the task runs in our process.
+    """
+
+    def __init__(self, func, type_name='.task'):
+        self.func = func
+        self.type_name = type_name
+        self.submit_time = time.time()
+
+        self.parent_ctx = context.current_context()
+        if self.parent_ctx is not None:
+            self.parent = (self.parent_ctx.id, self.parent_ctx.name,
+                           self.parent_ctx.enabled)
+        else:
+            self.parent = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['parent_ctx'] = None
+        return state
+
+    def __call__(self, *args, **kwargs):
+        if self.parent is None:
+            return self.func(*args, **kwargs)
+
+        queue_time = time.time() - self.submit_time
+
+        parent_id, parent_name, enabled = self.parent
+        ctx = context.Context(_child_name(parent_name, self.type_name),
+                              parent_id)
+        if not enabled:
+            ctx.enabled = False
+
+        start_time = timer.clock()
+        run_time = None
+        try:
+            with ctx:
+                ctx.set('queue_time', queue_time)
+                try:
+                    return self.func(*args, **kwargs)
+                finally:
+                    run_time = timer.clock() - start_time
+                    ctx.set('run_time', run_time)
+        finally:
+            self.record(queue_time, run_time)
+
+    def record(self, queue_time, run_time):
+        """Accumulate our times into our parent context, if we can
+
+        This is best effort: the parent may finish while we're at it, and
+        nothing that goes wrong here should get in the way of the task's own
+        result (or exception).
+        """
+        parent_ctx = self.parent_ctx
+        if parent_ctx is None or not parent_ctx.enabled or run_time is None:
+            return
+
+        try:
+            with _lock:
+                # The parent may have finished without waiting for us.
+                if not parent_ctx.writable:
+                    return
+
+                for key, elapsed in (('tasks.queue_time', queue_time),
+                                     ('tasks.run_time', run_time)):
+                    histogram = parent_ctx.get(key)
+                    if not isinstance(histogram, dict):
+                        histogram = None
+
+                    parent_ctx.set(key,
+                                   timer.update_histogram(histogram, elapsed))
+        except Exception:
+            log.exception("Failed to record task times in %r", parent_ctx.name)
+
+
+def _child_name(parent_name, type_name):
+    """Name a task's context the way Context() would as a child of the
+    context it was submitted from"""
+    if (type_name.startswith(('.', '^')) or
+            type_name.startswith(parent_name + '.')):
+        return context._resolve_name(parent_name, type_name)
+
+    # Not under the parent, so it's a separate branch of the context tree.
+    return type_name
+
+
+class Executor(object):
+    """Wraps a pool so the work submitted to it runs in child contexts
+
+    Works with concurrent.futures executors (submit() and map()) and
+    multiprocessing pools (apply_async(), map() and friends). Anything else is
+    passed through to the pool.
+    """
+
+    def __init__(self, pool, type_name='.task'):
+        self.pool = pool
+        self.type_name = type_name
+
+    def submit(self, func, *args, **kwargs):
+        return self.pool.submit(Task(func, self.type_name), *args, **kwargs)
+
+    def map(self, func, *args, **kwargs):
+        return self.pool.map(Task(func, self.type_name), *args, **kwargs)
+
+    def imap(self, func, *args, **kwargs):
+        return self.pool.imap(Task(func, self.type_name), *args, **kwargs)
+
+    def imap_unordered(self, func, *args, **kwargs):
+        return self.pool.imap_unordered(Task(func, self.type_name), *args,
+                                        **kwargs)
+
+    def apply(self, func, *args, **kwargs):
+        return self.pool.apply(Task(func, self.type_name), *args, **kwargs)
+
+    def apply_async(self, func, *args, **kwargs):
+        return self.pool.apply_async(Task(func, self.type_name), *args,
+                                     **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def __enter__(self):
+        self.pool.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.pool.__exit__(*args)
+
+
+def executor(pool, type_name='.task'):
+    """Wrap a thread or process pool to carry the current context into the
+    work submitted to it (see Executor)
+
+    type_name names the child contexts, relative to the context the work was
+    submitted from (or absolute, as for Context()).
+    """
+    return Executor(pool, type_name)
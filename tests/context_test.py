@@ -1,3 +1,5 @@
+import copy
+
 from testify import *
 
 import blueox
@@ -187,3 +189,208 @@ class BrokenCurrentContextTestCase(TestCase):
         # Non-writable context shouldn't show up.
         current_c = blueox.current_context()
         assert not current_c
+
+
+class ContextDataTestCase(TestCase):
+    @setup
+    def build_context(self):
+        self.context = context.Context('test')
+
+    def test_set_kwargs(self):
+        with self.context:
+            self.context.set('foo.bar', 1)
+            self.context.set('foo', baz=2)
+            self.context.set('foo', zoo=3)
+
+        assert_equal(self.context.data,
+                     {'foo': {'bar': 1, 'baz': 2, 'zoo': 3}})
+
+    def test_append(self):
+        with self.context:
+            self.context.append('foo.bar', 1)
+            self.context.append('foo.bar', 2)
+
+        assert_equal(self.context.data, {'foo': {'bar': [1, 2]}})
+
+    def test_add(self):
+        with self.context:
+            self.context.add('foo.bar', 1)
+            self.context.add('foo.bar', 2)
+            self.context.set('baz', {'count': 1})
+            self.context.add('baz.count', 1)
+
+        assert_equal(self.context.data,
+                     {'foo': {'bar': 3}, 'baz': {'count': 2}})
+
+    def test_get(self):
+        with self.context:
+            self.context.set('foo.bar', 1)
+
+        assert_equal(self.context.get('foo.bar'), 1)
+        assert_equal(self.context.get('foo'), {'bar': 1})
+        assert_equal(self.context.get('baz', 2), 2)
+
+    def test_read_only(self):
+        with self.context:
+            self.context.set('foo', 1)
+
+        data = self.context.data
+        assert_raises(TypeError, data.__setitem__, 'foo', 2)
+        assert_raises(TypeError, data.update, {'foo': 2})
+        assert_raises(AttributeError, setattr, self.context, 'data', {})
+        assert_equal(self.context.data, {'foo': 1})
+
+        # Copies can be changed
+        data_copy = copy.deepcopy(data)
+        data_copy['foo'] = 2
+        assert_equal(data_copy, {'foo': 2})
+
+
+class ContextStackTestCase(TestCase):
+    @teardown
+    def clear(self):
+        blueox.clear_contexts()
+
+    def test_out_of_order(self):
+        parent = blueox.Context('test')
+        parent.start()
+        child = blueox.Context('.foo')
+        child.start()
+
+        parent.stop()
+        assert_equal(context.find_closest_context('test.foo'), child)
+        assert_equal(context.find_closest_context('test'), child)
+
+        child.stop()
+        assert_equal(context.find_closest_context('test'), None)
+        assert_equal(context._stack().by_prefix, {})
+
+    def test_closest_first(self):
+        with blueox.Context('test.foo') as first_ctx:
+            with blueox.Context('test.bar'):
+                test_ctx = context.find_closest_context('test.baz')
+                assert_equal(test_ctx, first_ctx)
+
+    def test_deep(self):
+        names = []
+        with blueox.Context('test'):
+            for _ in range(2):
+                with blueox.Context('.foo'):
+                    with blueox.Context('.bar') as ctx:
+                        names.append(ctx.name)
+
+        assert_equal(names, ['test.foo.bar', 'test.foo.bar'])
+
+
+class DisabledContextTestCase(TestCase):
+    @setup
+    def build_context(self):
+        self.context = blueox.Context('test', sample=('test', 0.0))
+
+    def test(self):
+        assert not self.context.enabled
+        with self.context:
+            blueox.set('foo', True)
+            self.context.add('bar', 1)
+            self.context.append('baz', 1)
+
+        assert_equal(self.context.data, {})
+
+    def test_child(self):
+        with self.context:
+            with blueox.Context('.foo') as c:
+                assert not c.enabled
+                assert_equal(c.name, 'test.foo')
+                assert_equal(c.id, self.context.id)
+
+
+class EmptyConfigurationTestCase(TestCase):
+    @setup
+    def configure(self):
+        blueox.configure(None, None)
+
+    @teardown
+    def unconfigure(self):
+        context._recording_disabled = False
+
+    def test(self):
+        with blueox.Context('test') as c:
+            blueox.set('foo', True)
+
+        assert not c.enabled
+        assert_equal(c.data, {})
+
+
+class HashSampleTestCase(TestCase):
+    def test(self):
+        enabled = []
+        for _ in range(1000):
+            ctx = blueox.Context('test', sample=('test', 0.25, 'id'))
+            enabled.append(1 if ctx.enabled else 0)
+
+        assert 350 > sum(enabled) > 150
+
+    def test_consistent(self):
+        for _ in range(100):
+            ctx = blueox.Context('test', sample=('test', 0.25, 'id'))
+            with blueox.Context('test', ctx.id):
+                sub_ctx = blueox.Context('.sub', sample=('^', 0.25, 'id'))
+
+            other_ctx = blueox.Context('other', ctx.id,
+                                       sample=('other', 0.25, 'id'))
+
+            assert_equal(ctx.enabled, sub_ctx.enabled)
+            assert_equal(ctx.enabled, other_ctx.enabled)
+
+    def test_key(self):
+        for user_id in range(100):
+            enabled = set()
+            for _ in range(3):
+                with blueox.Context('test'):
+                    blueox.set('user', user_id)
+                    sub_ctx = blueox.Context('.sub',
+                                             sample=('..', 0.5, 'user'))
+                    enabled.add(sub_ctx.enabled)
+
+            assert_equal(len(enabled), 1)
+
+    def test_rates(self):
+        for value in range(100):
+            if context.hash_sampled(value, 0.1):
+                assert context.hash_sampled(value, 0.2)
+
+        assert not context.hash_sampled('foo', 0.0)
+        assert context.hash_sampled('foo', 1.0)
+
+
+class GreenletStorageTestCase(TestCase):
+    if context.greenlet is None:
+        def test_unavailable(self):
+            assert_raises(blueox.Error, context.GreenletStorage)
+    else:
+        @setup
+        def set_storage(self):
+            context.set_storage(context.GreenletStorage())
+
+        @teardown
+        def reset_storage(self):
+            context.set_storage(context.ThreadStorage())
+
+        def test(self):
+            seen = []
+
+            def request(name):
+                with blueox.Context(name):
+                    # Let the other greenlet start it's context
+                    context.greenlet.getcurrent().parent.switch()
+                    seen.append(context.current_context().name)
+
+            first = context.greenlet.greenlet(request)
+            second = context.greenlet.greenlet(request)
+            first.switch('first')
+            second.switch('second')
+            first.switch()
+            second.switch()
+
+            assert_equal(seen, ['first', 'second'])
+            assert_equal(context.current_context(), None)
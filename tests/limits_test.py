@@ -0,0 +1,146 @@
+from testify import *
+
+import blueox
+from blueox import limits
+
+
+class TypeLimitTestCase(TestCase):
+    def test_none(self):
+        limit = limits.TypeLimit()
+        assert all(limit.allow() for _ in range(100))
+
+    def test_rate(self):
+        limit = limits.TypeLimit(rate=0.25)
+        allowed = sum(1 for _ in range(1000) if limit.allow())
+        assert 350 > allowed > 150
+
+    def test_max_per_sec(self):
+        limit = limits.TypeLimit(max_per_sec=10)
+        allowed = sum(1 for _ in range(100) if limit.allow())
+        assert_equal(allowed, 10)
+
+        # Pretend a second has gone by
+        limit.last_fill -= 1.0
+        allowed = sum(1 for _ in range(100) if limit.allow())
+        assert_equal(allowed, 10)
+
+
+class SetLimitsTestCase(TestCase):
+    @teardown
+    def clear_limits(self):
+        limits.clear_limits()
+
+    def test(self):
+        limits.set_limits({'foo': {'rate': 0.0}})
+        assert not limits.allow('foo')
+        assert limits.allow('bar')
+
+    def test_unchanged(self):
+        limits.set_limits({'foo': {'max_per_sec': 10}})
+        limit = limits._limits['foo']
+
+        limits.set_limits({'foo': {'max_per_sec': 10}})
+        assert limits._limits['foo'] is limit
+
+        limits.set_limits({'foo': {'max_per_sec': 20}})
+        assert limits._limits['foo'] is not limit
+
+
+class ContextLimitTestCase(TestCase):
+    @setup
+    def set_limits(self):
+        limits.set_limits({'test.foo': {'rate': 0.0}})
+
+    @teardown
+    def clear_limits(self):
+        limits.clear_limits()
+
+    def test(self):
+        with blueox.Context('test') as ctx:
+            assert ctx.enabled
+            with blueox.Context('.foo') as sub_ctx:
+                assert not sub_ctx.enabled
+                with blueox.Context('.bar') as sub_sub_ctx:
+                    assert not sub_sub_ctx.enabled
+
+
+class LoadShedderTestCase(TestCase):
+    @setup
+    def build_shedder(self):
+        self.shedder = limits.LoadShedder()
+        self.now = self.shedder.last_adjust
+
+    def adjust(self, queue_fill):
+        self.now += limits.SHED_ADJUST_INTERVAL
+        self.shedder.adjust(queue_fill, self.now)
+
+    def test_failures(self):
+        self.shedder.record_failure()
+        self.adjust(0.0)
+        assert_equal(self.shedder.keep_ratio, 0.5)
+
+        # Still failing
+        self.shedder.record_failure()
+        self.adjust(0.0)
+        assert_equal(self.shedder.keep_ratio, 0.25)
+
+        # Recovered
+        self.adjust(0.0)
+        self.adjust(0.0)
+        assert_equal(self.shedder.keep_ratio, 1.0)
+
+    def test_queue_fill(self):
+        self.adjust(limits.QUEUE_HIGH_WATER)
+        assert_equal(self.shedder.keep_ratio, 0.5)
+
+        # Not drained yet
+        self.adjust(limits.QUEUE_HIGH_WATER / 2)
+        assert_equal(self.shedder.keep_ratio, 0.5)
+
+        self.adjust(limits.QUEUE_LOW_WATER)
+        assert_equal(self.shedder.keep_ratio, 1.0)
+
+    def test_min_keep_ratio(self):
+        for _ in range(20):
+            self.adjust(1.0)
+        assert_equal(self.shedder.keep_ratio, limits.MIN_KEEP_RATIO)
+
+    def test_too_soon(self):
+        self.shedder.record_failure()
+        self.shedder.adjust(0.0, self.now)
+        assert_equal(self.shedder.keep_ratio, 1.0)
+
+    def test_report(self):
+        assert_equal(self.shedder.report(), None)
+
+        self.shedder.record_failure()
+        self.adjust(0.0)
+
+        self.shedder.keep_ratio = 0.0
+        assert not self.shedder.allow('foo')
+
+        report = self.shedder.report()
+        assert_equal(report, {'keep_ratio': 0.0,
+                              'send_failures': 1,
+                              'shed': {'foo': 1}})
+
+        assert_equal(self.shedder.failures, 0)
+        assert_equal(self.shedder.shed, {})
+
+
+class ContextSheddingTestCase(TestCase):
+    @setup
+    def shed_everything(self):
+        limits.shedder.keep_ratio = 0.0
+
+    @teardown
+    def reset_shedder(self):
+        limits.reset_shedder()
+
+    def test(self):
+        with blueox.Context('test') as ctx:
+            assert ctx.enabled
+            with blueox.Context('.foo') as sub_ctx:
+                assert not sub_ctx.enabled
+
+        assert_equal(limits.shedder.shed, {'test.foo': 1})
@@ -0,0 +1,91 @@
+import os
+
+from testify import *
+
+from blueox import context
+from blueox import metrics
+
+
+class MetricsTestCase(TestCase):
+    @setup
+    def configure_recorder(self):
+        self.events = []
+        context._recorder_function = self.events.append
+
+    @teardown
+    def unconfigure_recorder(self):
+        context._recorder_function = None
+
+    @teardown
+    def reset_metrics(self):
+        metrics.close()
+        metrics.reset()
+
+    def test_counters(self):
+        metrics.incr('cache.hits')
+        metrics.incr('cache.hits', 2)
+        metrics.incr('cache.misses')
+
+        metrics.flush()
+
+        assert_equal(len(self.events), 1)
+        assert_equal(self.events[0].name, metrics.METRICS_TYPE)
+        assert_equal(self.events[0].data['counters'],
+                     {'cache.hits': 3, 'cache.misses': 1})
+
+        # Counters start over after each flush
+        metrics.flush()
+        assert_equal(len(self.events), 1)
+
+    def test_gauges(self):
+        metrics.gauge('pool.size', 10)
+        metrics.gauge('pool.size', 5)
+
+        metrics.flush()
+        metrics.flush()
+
+        assert_equal(len(self.events), 2)
+        for event in self.events:
+            assert_equal(event.data['gauges'], {'pool.size': 5})
+
+    def test_timers(self):
+        metrics.timing('render', 0.2)
+        metrics.timing('render', 0.1)
+        metrics.timing('render', 0.3)
+
+        with metrics.timeit('query'):
+            pass
+
+        metrics.flush()
+
+        timers = self.events[0].data['timers']
+        assert_equal(timers['render']['count'], 3)
+        assert_almost_equal(timers['render']['sum'], 0.6, 6)
+        assert_equal(timers['render']['min'], 0.1)
+        assert_equal(timers['render']['max'], 0.3)
+        assert_equal(sum(timers['render']['buckets']), 3)
+        assert_equal(timers['query']['count'], 1)
+
+    def test_nothing(self):
+        metrics.flush()
+        assert_equal(self.events, [])
+
+    def test_flusher(self):
+        metrics.incr('foo')
+        assert metrics._flusher.is_alive()
+
+        metrics.close()
+        assert_equal(metrics._flusher, None)
+        assert_equal(self.events[0].data['counters'], {'foo': 1})
+
+    def test_fork(self):
+        metrics.incr('foo')
+
+        # Pretend we've been forked
+        metrics._flusher_pid = -1
+
+        metrics.incr('bar')
+        assert_equal(metrics._flusher_pid, os.getpid())
+
+        metrics.flush()
+        assert_equal(self.events[0].data['counters'], {'bar': 1})
@@ -1,5 +1,13 @@
+import collections
+import os
 import random
+import shutil
 import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import decimal
 import datetime
 
@@ -7,15 +15,33 @@ from testify import *
 import zmq
 import msgpack
 
+import blueox
 from blueox import utils
 from blueox import network
 from blueox import context
+from blueox import limits
+from blueox import ports
 
 class NoNetworkSendTestCase(TestCase):
     def test(self):
         """Verify that if network isn't setup, send just does nothing"""
         network.send(context.Context('test', 1))
 
+class LazyImportTestCase(TestCase):
+    def test(self):
+        """Verify we aren't imported until we're configured"""
+        script = ("import sys, blueox\n"
+                  "with blueox.Context('test'):\n"
+                  "    blueox.set('foo', True)\n"
+                  "blueox.shutdown()\n"
+                  "assert 'zmq' not in sys.modules\n"
+                  "blueox.configure('127.0.0.1', 3514)\n"
+                  "assert 'blueox.network' in sys.modules\n"
+                  "blueox.shutdown()\n")
+
+        subprocess.check_call([sys.executable, '-c', script])
+
+
 class NetworkSendTestCase(TestCase):
     @setup
     def build_context(self):
@@ -36,6 +62,7 @@ class NetworkSendTestCase(TestCase):
 
     @setup
     def build_server_socket(self):
+        self.server_context = None
         self.server = network._zmq_context.socket(zmq.PULL)
         self.server.bind("tcp://127.0.0.1:%d" % self.port)
 
@@ -63,6 +90,657 @@ class NetworkSendTestCase(TestCase):
         assert_equal(utils.get_deep(data['body'], "bar.baz"), 10.0)
 
 
+class SharedNetworkSendTestCase(TestCase):
+    @setup
+    def init_network(self):
+        self.port = random.randint(30000, 40000)
+        network.init("127.0.0.1", self.port, shared=True)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @setup
+    def build_server_socket(self):
+        self.server_context = None
+        self.server = network._zmq_context.socket(zmq.PULL)
+        self.server.bind("tcp://127.0.0.1:%d" % self.port)
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    def test(self):
+        def send_events():
+            for ndx in range(10):
+                with context.Context('test', ndx):
+                    context.set('foo', True)
+
+        threads = [threading.Thread(target=send_events) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert network._shared_socket.zmq_sockets
+        assert_equal(getattr(network.threadLocal, 'zmq_sockets', None), None)
+
+        received = 0
+        while self.server.poll(500):
+            self.server.recv_multipart()
+            received += 1
+
+        assert_equal(received, 50)
+
+    def test_close(self):
+        with context.Context('test', 1):
+            pass
+
+        shared_socket = network._shared_socket
+        network.close()
+
+        assert_equal(network._shared_socket, None)
+        assert_equal(shared_socket.zmq_sockets, None)
+
+
+class ForkTestCase(TestCase):
+    @setup
+    def init_network(self):
+        self.port = random.randint(30000, 40000)
+        network.init("127.0.0.1", self.port)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @setup
+    def build_server_socket(self):
+        self.server_context = None
+        self.server = network._zmq_context.socket(zmq.PULL)
+        self.server.bind("tcp://127.0.0.1:%d" % self.port)
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    def test(self):
+        with context.Context('test', 'parent'):
+            pass
+
+        parent_socket = network.threadLocal.zmq_sockets[0]
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                with context.Context('test', 'child'):
+                    pass
+
+                assert network.threadLocal.zmq_sockets[0] is not parent_socket
+                zmq_context = network._zmq_context
+                network.close()
+                zmq_context.term()
+                status = 0
+            finally:
+                # Failures in the child can only reach us by it's exit status.
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        assert_equal(os.WIFEXITED(status), True)
+        assert_equal(os.WEXITSTATUS(status), 0)
+
+        ids = []
+        while self.server.poll(500):
+            _, raw_data = self.server.recv_multipart()
+            ids.append(msgpack.unpackb(raw_data)['id'])
+
+        assert_equal(sorted(ids), ['child', 'parent'])
+
+    def test_after_fork(self):
+        with context.Context('test', 1):
+            pass
+
+        zmq_context = network._zmq_context
+        zmq_socket = network.threadLocal.zmq_sockets[0]
+
+        # Pretend we're the child
+        network._pid = None
+
+        with context.Context('test', 2):
+            pass
+
+        assert_equal(network._pid, os.getpid())
+        assert network._zmq_context is not zmq_context
+        assert zmq_context in network._orphaned_contexts
+        assert network.threadLocal.zmq_sockets[0] is not zmq_socket
+
+        network._orphaned_contexts.remove(zmq_context)
+        zmq_socket.close(linger=0)
+
+    def test_after_fork_threads(self):
+        with context.Context('test', 1):
+            pass
+
+        zmq_context = network._zmq_context
+        zmq_socket = network.threadLocal.zmq_sockets[0]
+        generation = network._generation
+
+        network._pid = None
+
+        # All our threads notice at once, but only one rebuilds.
+        threads = [threading.Thread(target=network._check_fork)
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equal(network._pid, os.getpid())
+        assert_equal(network._orphaned_contexts, [zmq_context])
+        assert_equal(network._generation, generation + 1)
+
+        network._orphaned_contexts.remove(zmq_context)
+        zmq_socket.close(linger=0)
+
+
+class HashRingTestCase(TestCase):
+    def test_route(self):
+        ring = network.HashRing(3)
+        for key in range(100):
+            route = ring.route(key)
+            assert_equal(sorted(route), [0, 1, 2])
+            assert_equal(route[0], ring.primary(key))
+
+    def test_spread(self):
+        ring = network.HashRing(3)
+        counts = collections.Counter(ring.primary(os.urandom(8).encode('hex'))
+                                     for _ in range(3000))
+        for endpoint in range(3):
+            assert counts[endpoint] > 500
+
+    def test_consistent(self):
+        ring = network.HashRing(3)
+        bigger_ring = network.HashRing(4)
+
+        keys = [os.urandom(8).encode('hex') for _ in range(1000)]
+        moved = [key for key in keys
+                 if ring.primary(key) != bigger_ring.primary(key)]
+
+        # Only those going to our new endpoint should have moved
+        assert all(bigger_ring.primary(key) == 3 for key in moved)
+        assert len(moved) < 400
+
+
+class MultiEndpointConfigureTestCase(TestCase):
+    @teardown
+    def unconfigure(self):
+        context._recorder_function = None
+        network.close()
+
+    def test_list(self):
+        blueox.configure(['127.0.0.1:3514', '127.0.0.1:3515'], None)
+        assert_equal(network._connect_strs, ['tcp://127.0.0.1:3514',
+                                             'tcp://127.0.0.1:3515'])
+        assert_equal(context._recorder_function, network.send)
+
+    def test_tuple(self):
+        blueox.configure(('127.0.0.1:3514', '127.0.0.1:3515'), None)
+        assert_equal(len(network._connect_strs), 2)
+
+    def test_default_configure(self):
+        blueox.default_configure('127.0.0.1:3514,127.0.0.1:3515')
+        assert_equal(network._connect_strs, ['tcp://127.0.0.1:3514',
+                                             'tcp://127.0.0.1:3515'])
+
+
+class MultiEndpointSendTestCase(TestCase):
+    @setup
+    def init_network(self):
+        self.ports = random.sample(range(30000, 40000), 2)
+        network.init(["127.0.0.1:%d" % port for port in self.ports], None)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    @teardown
+    def destroy_servers(self):
+        for server in self.servers:
+            server.close(linger=0)
+
+    def build_servers(self, count):
+        self.servers = []
+        for port in self.ports[:count]:
+            server = network._zmq_context.socket(zmq.PULL)
+            server.bind("tcp://127.0.0.1:%d" % port)
+            self.servers.append(server)
+
+        # We won't send to a collector until we're connected.
+        network._with_socket_owner(network._connect)()
+        time.sleep(0.2)
+
+    def recv_ids(self, server):
+        ids = []
+        while server.poll(200):
+            _, raw_data = server.recv_multipart()
+            ids.append(msgpack.unpackb(raw_data)['id'])
+
+        return ids
+
+    def test(self):
+        self.build_servers(2)
+
+        ids = [os.urandom(8).encode('hex') for _ in range(20)]
+        for event_id in ids:
+            with context.Context('test', event_id):
+                pass
+            with context.Context('test', event_id):
+                pass
+
+        for endpoint, server in enumerate(self.servers):
+            expected = [event_id for event_id in ids
+                        if network._ring.primary(event_id) == endpoint]
+            assert_equal(sorted(self.recv_ids(server)), sorted(expected * 2))
+
+    def test_failover(self):
+        self.build_servers(1)
+
+        ids = [os.urandom(8).encode('hex') for _ in range(20)]
+        for event_id in ids:
+            with context.Context('test', event_id):
+                pass
+
+        assert_equal(sorted(self.recv_ids(self.servers[0])), sorted(ids))
+        assert network._ring.is_down(1, time.time())
+
+
+class IPCNetworkSendTestCase(TestCase):
+    @setup
+    def build_ipc_path(self):
+        self.ipc_dir = tempfile.mkdtemp()
+        os.environ[ports.ENV_VAR_IPC_DIR] = self.ipc_dir
+        self.port = random.randint(30000, 40000)
+        self.path = ports.default_ipc_path(self.port)
+
+    @teardown
+    def remove_ipc_path(self):
+        del os.environ[ports.ENV_VAR_IPC_DIR]
+        shutil.rmtree(self.ipc_dir)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    def build_server_socket(self):
+        self.server_context = None
+        self.server = network._zmq_context.socket(zmq.PULL)
+        self.server.bind("ipc://" + self.path)
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+        if self.server_context:
+            self.server_context.term()
+
+    def check_event(self):
+        with context.Context('test', 1):
+            context.set('foo', True)
+
+        assert self.server.poll(1000)
+        event_meta, raw_data = self.server.recv_multipart()
+        assert_equal(msgpack.unpackb(raw_data)['body'], {'foo': True})
+
+    def test_ipc(self):
+        network.init("ipc://" + self.path, None)
+        self.build_server_socket()
+        self.check_event()
+
+    def test_local(self):
+        # The socket has to exist before we know to use it.
+        self.server_context = zmq.Context()
+        self.server = self.server_context.socket(zmq.PULL)
+        self.server.bind("ipc://" + self.path)
+
+        network.init("127.0.0.1", self.port)
+        assert_equal(network._connect_strs, ["ipc://" + self.path])
+        self.check_event()
+
+
+class ThreadedNetworkSendTestCase(TestCase):
+    @setup
+    def init_network(self):
+        self.port = random.randint(30000, 40000)
+        network.init("127.0.0.1", self.port, threaded=True)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @setup
+    def build_server_socket(self):
+        self.server_context = None
+        self.server = network._zmq_context.socket(zmq.PULL)
+        self.server.bind("tcp://127.0.0.1:%d" % self.port)
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    def test(self):
+        with context.Context('test', 1) as ctx:
+            ctx.set('foo', True)
+
+        end_time = ctx.end_time
+
+        event_meta, raw_data = self.server.recv_multipart()
+        network.check_meta_version(event_meta)
+
+        data = msgpack.unpackb(raw_data)
+        assert_equal(data['id'], 1)
+        assert_equal(data['type'], 'test')
+        assert_equal(data['end'], end_time)
+        assert_equal(data['body']['foo'], True)
+
+    def test_shutdown(self):
+        for ndx in range(10):
+            with context.Context('test', ndx):
+                pass
+
+        # Closing should wait for our sender to empty it's queue.
+        network.close()
+
+        for ndx in range(10):
+            event_meta, raw_data = self.server.recv_multipart()
+            assert_equal(msgpack.unpackb(raw_data)['id'], ndx)
+
+
+class BatchNetworkSendTestCase(TestCase):
+    @setup
+    def init_network(self):
+        self.port = random.randint(30000, 40000)
+        network.init("127.0.0.1", self.port, batch=True)
+
+    @setup
+    def configure_network(self):
+        context._recorder_function = network.send
+
+    @teardown
+    def unconfigure_network(self):
+        context._recorder_function = None
+
+    @setup
+    def build_server_socket(self):
+        self.server_context = None
+        self.server = network._zmq_context.socket(zmq.PULL)
+        self.server.bind("tcp://127.0.0.1:%d" % self.port)
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+
+    @teardown
+    def destory_network(self):
+        network.close()
+
+    def test(self):
+        for ndx in range(3):
+            with context.Context('test', ndx) as ctx:
+                ctx.set('foo', ndx)
+
+        events = []
+        while len(events) < 3:
+            meta_data, batch_data = self.server.recv_multipart()
+            assert_equal(network.meta_version(meta_data),
+                         network.META_BATCH_VERSION)
+            events += list(network.unpack_batch(meta_data, batch_data))
+
+        for ndx, (end_time, host, type_name, data) in enumerate(events):
+            assert_equal(type_name, 'test')
+            data = msgpack.unpackb(data)
+            assert_equal(data['id'], ndx)
+            assert_equal(data['end'], end_time)
+            assert_equal(data['host'], host)
+            assert_equal(data['body']['foo'], ndx)
+
+
+class BatchTestCase(TestCase):
+    def test(self):
+        batch = network.Batch('localhost')
+        batch.add(1.0, 'foo', 'hello')
+        batch.add(2.0, 'foo.bar', 'world')
+
+        assert_equal(len(batch), 2)
+        assert_equal(batch.size, 10)
+
+        meta_data, batch_data = batch.pack()
+        assert_equal(batch_data, 'helloworld')
+
+        events = list(network.unpack_batch(meta_data, batch_data))
+        assert_equal(events, [(1.0, 'localhost', 'foo', 'hello'),
+                              (2.0, 'localhost', 'foo.bar', 'world')])
+
+    def test_truncated(self):
+        batch = network.Batch('localhost')
+        batch.add(1.0, 'foo', 'hello')
+
+        meta_data, batch_data = batch.pack()
+        with assert_raises(ValueError):
+            list(network.unpack_batch(meta_data, batch_data[:2]))
+
+
+class SenderThreadDropTestCase(TestCase):
+    @teardown
+    def reset_shedder(self):
+        limits.reset_shedder()
+
+    def test(self):
+        # Not started, so nothing will drain our queue
+        sender = network.SenderThread(max_pending=1)
+
+        sender.enqueue(context.Context('test', 1))
+        sender.enqueue(context.Context('test', 2))
+
+        assert_equal(sender.queue.qsize(), 1)
+        assert_equal(sender.dropped, 1)
+        assert_equal(limits.shedder.failures, 1)
+
+
+class PendingBytesTestCase(TestCase):
+    @setup
+    def shrink_socket_queue(self):
+        self.orig_max_queued = network.MAX_QUEUED_MESSAGES
+        network.MAX_QUEUED_MESSAGES = 1
+
+    @teardown
+    def restore_socket_queue(self):
+        network.MAX_QUEUED_MESSAGES = self.orig_max_queued
+
+    @setup
+    def init_network(self):
+        self.port = random.randint(30000, 40000)
+
+        meta_data, context_data = network._serialize_context(
+            context.Context('test', 1))
+        self.data_size = len(context_data)
+        self.msg_size = len(meta_data) + len(context_data)
+        network.init("127.0.0.1", self.port,
+                     max_pending_bytes=int(self.msg_size * 2.5))
+
+    @teardown
+    def destroy_network(self):
+        network.close()
+        network._pop_dropped()
+        limits.reset_shedder()
+
+    def test(self):
+        # Nobody is listening, so ZeroMQ will only take so many.
+        sent = 10
+        for ndx in range(sent):
+            network.send(context.Context('test', ndx))
+
+        assert_equal(network.stats()['pending_bytes'], self.msg_size * 2)
+        assert_equal(len(network._pending), 2)
+
+        # Every event we couldn't send counts as a failure, not just the first.
+        assert_equal(limits.shedder.failures, sent - 1)
+
+        dropped = network._pop_dropped()['test']
+        assert dropped['events'] > 0
+        assert_equal(dropped['bytes'], dropped['events'] * self.data_size)
+
+        server = network._zmq_context.socket(zmq.PULL)
+        server.bind("tcp://127.0.0.1:%d" % self.port)
+        try:
+            for _ in range(100):
+                network._send_pending()
+                if not network._pending:
+                    break
+                time.sleep(0.01)
+
+            assert_equal(network.stats()['pending_bytes'], 0)
+
+            received = 0
+            while server.poll(100):
+                server.recv_multipart()
+                received += 1
+
+            assert_equal(received, sent - dropped['events'])
+        finally:
+            server.close(linger=0)
+
+    def test_thread_exit(self):
+        def send_events():
+            for ndx in range(2):
+                network.send(context.Context('test', ndx))
+
+        thread = threading.Thread(target=send_events)
+        thread.start()
+        thread.join()
+
+        # Whatever the thread was holding is still ours to send.
+        assert_equal(network.stats()['pending_bytes'], self.msg_size)
+
+        server = network._zmq_context.socket(zmq.PULL)
+        server.bind("tcp://127.0.0.1:%d" % self.port)
+        try:
+            for _ in range(100):
+                network._send_pending()
+                if not network._pending:
+                    break
+                time.sleep(0.01)
+
+            assert_equal(network.stats()['pending_bytes'], 0)
+
+            received = []
+            while server.poll(100):
+                received.append(msgpack.unpackb(server.recv_multipart()[1]))
+
+            # The first was handed to the thread's own socket, so it's up to
+            # ZeroMQ whether it makes it after the thread is gone.
+            assert_in(1, [event['id'] for event in received])
+        finally:
+            server.close(linger=0)
+
+    def test_queue_fill(self):
+        for ndx in range(3):
+            network.send(context.Context('test', ndx))
+
+        assert network._queue_fill() > limits.QUEUE_HIGH_WATER
+
+
+class CheckLoadTestCase(TestCase):
+    @setup
+    def configure_recorder(self):
+        self.events = []
+        context._recorder_function = self.events.append
+
+    @setup
+    def reset_client_stats(self):
+        network._last_client_stats = time.time()
+
+    @teardown
+    def unconfigure_recorder(self):
+        context._recorder_function = None
+
+    @teardown
+    def reset_shedder(self):
+        limits.reset_shedder()
+        network._last_client_stats = time.time()
+
+    def test(self):
+        limits.shedder.record_failure()
+        network._check_load(time.time() + limits.SHED_ADJUST_INTERVAL)
+        assert_equal(limits.shedder.keep_ratio, 0.5)
+        assert_equal(self.events, [])
+
+        with context.Context('test'):
+            for _ in range(100):
+                context.Context('.foo')
+
+        # By the time we report, we've recovered.
+        network._check_load(time.time() + network.CLIENT_STATS_INTERVAL)
+
+        assert_equal(len(self.events), 2)
+        stats_ctx = self.events[-1]
+        assert_equal(stats_ctx.name, network.CLIENT_STATS_TYPE)
+        assert_equal(stats_ctx.data['send_failures'], 1)
+        assert_equal(stats_ctx.data['keep_ratio'], 1.0)
+        assert 80 > stats_ctx.data['shed']['test.foo'] > 20
+
+    def test_dropped(self):
+        network._record_drop('test', 100)
+        network._record_drop('test', 200)
+        network._check_load(time.time() + network.CLIENT_STATS_INTERVAL)
+
+        assert_equal(len(self.events), 1)
+        assert_equal(self.events[0].data['dropped'],
+                     {'test': {'events': 2, 'bytes': 300}})
+
+    def test_nothing_to_report(self):
+        network._check_load(time.time() + network.CLIENT_STATS_INTERVAL)
+        assert_equal(self.events, [])
+
+
 class SerializeContextTestCase(TestCase):
     @setup
     def build_context(self):
@@ -82,16 +760,110 @@ class SerializeContextTestCase(TestCase):
             datetime.datetime.fromtimestamp(float(data['body']['datetime_value'])),
             datetime.datetime(2013, 12, 10, 12, 12, 12))
 
+    def test_to_dict(self):
+        with self.context:
+            self.context.set('foo.bar', 10)
+
+        meta_data, context_data = network._serialize_context(self.context)
+        data = msgpack.unpackb(context_data)
+
+        assert_equal(data, self.context.to_dict())
+
+    def test_after_failure(self):
+        with self.context:
+            self.context.set('value', 2**64)
+
+        network._serialize_context(self.context)
+
+        # Our packer shouldn't be left with any partial data
+        other_context = context.Context('other', 2)
+        with other_context:
+            other_context.set('foo', True)
+
+        meta_data, context_data = network._serialize_context(other_context)
+        data = msgpack.unpackb(context_data)
+        assert_equal(data['body'], {'foo': True})
+
     def test_exception(self):
         with self.context:
             self.context.set('value', Exception('hello'))
+            self.context.set('other_value', 1)
+
+        meta_data, context_data = network._serialize_context(self.context)
+        data = msgpack.unpackb(context_data)
+
+        # The serialization should fail, but that just means we don't have that
+        # piece of data.
+        assert_equal(data['body'], {'value': None, 'other_value': 1})
+
+    def test_mapping(self):
+        class Headers(collections.Mapping):
+            def __getitem__(self, key):
+                return {'Host': 'localhost'}[key]
+
+            def __iter__(self):
+                return iter(['Host'])
+
+            def __len__(self):
+                return 1
+
+        with self.context:
+            self.context.set('headers', Headers())
 
         meta_data, context_data = network._serialize_context(self.context)
         data = msgpack.unpackb(context_data)
+        assert_equal(data['body']['headers'], {'Host': 'localhost'})
+
+
+class EventEnvelopeTestCase(TestCase):
+    @teardown
+    def clear_envelope(self):
+        network._envelope = None
+
+    def test(self):
+        pid, host, envelope = network._event_envelope()
+        assert_equal(pid, os.getpid())
+        assert_equal(host, os.uname()[1])
+
+        assert network._event_envelope()[2] is envelope
+
+    def test_fork(self):
+        pid, host, envelope = network._event_envelope()
+
+        # Pretend we were forked from some other process
+        network._envelope = (pid + 1, host, envelope)
+
+        assert_equal(network._event_envelope()[0], pid)
 
-        # The serialization should fail, but that just means we don't have any
-        # data.
-        assert_equal(data['body'], None)
 
+class LimitsPollerTestCase(TestCase):
+    @setup
+    def build_server(self):
+        self.zmq_context = zmq.Context()
+        self.server = self.zmq_context.socket(zmq.REP)
+        self.port = self.server.bind_to_random_port("tcp://127.0.0.1")
+
+    @teardown
+    def destroy_server(self):
+        self.server.close(linger=0)
+        self.zmq_context.term()
+
+    @teardown
+    def clear_limits(self):
+        limits.clear_limits()
+
+    def test(self):
+        def respond():
+            request = msgpack.unpackb(self.server.recv())
+            assert_equal(request['cmd'], 'LIMITS')
+            self.server.send(msgpack.packb(
+                {'limits': {'test': {'rate': 0.5}}}))
+
+        server_thread = threading.Thread(target=respond)
+        server_thread.start()
 
+        poller = network.LimitsPoller("127.0.0.1:%d" % self.port)
+        poller.poll(self.zmq_context)
+        server_thread.join()
 
+        assert_equal(limits._limits['test'].rate, 0.5)
@@ -1,4 +1,9 @@
 import os
+import random
+import shutil
+import socket
+import stat
+import tempfile
 from testify import *
 
 from blueox import ports
@@ -71,3 +76,105 @@ class DefaultCollectHost(TestCase):
         os.environ['BLUEOX_HOST'] = 'master:123'
         host = ports.default_collect_host()
         assert_equal(host, "master:123")
+
+    def test_ipc(self):
+        os.environ['BLUEOX_HOST'] = 'ipc:///tmp/oxd.sock'
+        host = ports.default_collect_host()
+        assert_equal(host, "ipc:///tmp/oxd.sock")
+
+
+class DefaultLimitsHost(TestCase):
+    @teardown
+    def clear_env(self):
+        try:
+            del os.environ['BLUEOX_LIMITS_HOST']
+        except KeyError:
+            pass
+
+    def test_empty(self):
+        host = ports.default_limits_host()
+        assert_equal(host, None)
+
+    def test_host(self):
+        host = ports.default_limits_host('master')
+        assert_equal(host, "master:3513")
+
+    def test_env(self):
+        os.environ['BLUEOX_LIMITS_HOST'] = 'master:123'
+        host = ports.default_limits_host()
+        assert_equal(host, "master:123")
+
+
+class CollectConnectStr(TestCase):
+    @setup
+    def build_ipc_path(self):
+        self.ipc_dir = tempfile.mkdtemp()
+        os.environ[ports.ENV_VAR_IPC_DIR] = self.ipc_dir
+        self.port = random.randint(30000, 40000)
+        self.path = ports.default_ipc_path(self.port)
+        self.server = None
+
+    @teardown
+    def remove_ipc_path(self):
+        if self.server:
+            self.server.close()
+
+        del os.environ[ports.ENV_VAR_IPC_DIR]
+        shutil.rmtree(self.ipc_dir)
+
+    def listen(self):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+
+    def test_default_ipc_path(self):
+        assert_equal(self.path, os.path.join(self.ipc_dir,
+                                             'collect-%d.sock' % self.port))
+
+        del os.environ[ports.ENV_VAR_IPC_DIR]
+        try:
+            assert_equal(os.path.dirname(ports.default_ipc_path(self.port)),
+                         ports.DEFAULT_IPC_DIR)
+        finally:
+            os.environ[ports.ENV_VAR_IPC_DIR] = self.ipc_dir
+
+    def test_tcp(self):
+        assert_equal(ports.collect_connect_str('master:3514'),
+                     "tcp://master:3514")
+
+    def test_ipc(self):
+        assert_equal(ports.collect_connect_str('ipc:///tmp/oxd.sock'),
+                     "ipc:///tmp/oxd.sock")
+
+    def test_local(self):
+        host = "127.0.0.1:%d" % self.port
+        assert_equal(ports.collect_connect_str(host), "tcp://" + host)
+
+        self.listen()
+        assert_equal(ports.collect_connect_str(host), "ipc://" + self.path)
+
+        # Only for local hosts
+        assert_equal(ports.collect_connect_str("master:%d" % self.port),
+                     "tcp://master:%d" % self.port)
+
+    def test_not_socket(self):
+        open(self.path, 'w').close()
+        assert_equal(ports.is_listening(self.path), False)
+
+    def test_stale(self):
+        # Like an oxd that was killed without cleaning up.
+        self.listen()
+        self.server.close()
+        self.server = None
+
+        assert_equal(stat.S_ISSOCK(os.stat(self.path).st_mode), True)
+        assert_equal(ports.is_listening(self.path), False)
+
+    def test_not_writable(self):
+        self.listen()
+        os.chmod(self.path, 0555)
+        if os.access(self.path, os.W_OK):
+            # We're root, who can write to anything.
+            return
+
+        assert_equal(ports.is_listening(self.path), False)
@@ -11,3 +11,68 @@ class SimpleTestCase(TestCase):
                 time.sleep(0.25)
 
         assert 1.0 > context.data['test_time'] > 0.0
+
+
+class HistogramTestCase(TestCase):
+    def test(self):
+        context = blueox.Context('test', 1)
+        with context:
+            for _ in range(3):
+                with blueox.timeit('test_time', histogram=True):
+                    pass
+
+        histogram = context.data['test_time']
+        assert_equal(histogram['count'], 3)
+        assert_equal(len(histogram['buckets']), blueox.timer.HISTOGRAM_BUCKETS)
+        assert_equal(sum(histogram['buckets']), 3)
+        assert histogram['min'] <= histogram['max'] <= histogram['sum']
+
+    def test_cpu(self):
+        context = blueox.Context('test', 1)
+        with context:
+            with blueox.timeit('test_time', histogram=True, cpu=True):
+                pass
+
+        assert_equal(context.data['test_time']['count'], 1)
+        assert_equal(context.data['test_time_cpu']['count'], 1)
+
+    def test_buckets(self):
+        histogram = None
+        for elapsed in (0.0, 0.0001, 0.00015, 0.0002, 0.1, 1000.0):
+            histogram = blueox.timer.update_histogram(histogram, elapsed)
+
+        buckets = histogram['buckets']
+        assert_equal(buckets[:3], [1, 2, 1])
+        assert_equal(buckets[10], 1)
+        assert_equal(buckets[-1], 1)
+        assert_equal(histogram['min'], 0.0)
+        assert_equal(histogram['max'], 1000.0)
+
+
+class NoContextTestCase(TestCase):
+    def test(self):
+        with blueox.timeit('test_time') as timer:
+            pass
+
+        assert_equal(timer, blueox.timer._null_timer)
+
+
+class DisabledContextTestCase(TestCase):
+    def test(self):
+        context = blueox.Context('test', 1, sample=('test', 0.0))
+        with context:
+            with blueox.timeit('test_time'):
+                pass
+
+        assert_equal(context.data, {})
+
+
+class ClockTestCase(TestCase):
+    def test_monotonic(self):
+        clock = blueox.timer._monotonic_clock()
+        if clock is None:
+            return
+
+        first = clock()
+        time.sleep(0.01)
+        assert 1.0 > clock() - first > 0.0
@@ -1,3 +1,5 @@
+import decimal
+
 from testify import *
 
 from blueox import utils
@@ -114,3 +116,128 @@ class ExistingSetDeepTestCase(TestCase):
     def test(self):
         """verify we can set a shallow value"""
         assert_equal(utils.get_deep(self.value, 'foo.baz'), True)
+
+
+class RegisterEncoderTestCase(TestCase):
+    class Thing(object):
+        pass
+
+    class SubThing(Thing):
+        pass
+
+    @setup
+    def save_encoders(self):
+        self.encoders = list(utils._encoders)
+
+    @teardown
+    def restore_encoders(self):
+        utils._encoders[:] = self.encoders
+        utils._encoders_by_class.clear()
+
+    def test_unknown(self):
+        with assert_raises(TypeError):
+            utils.msgpack_encode_default(self.Thing())
+
+    def test_register(self):
+        utils.register_encoder(self.Thing, lambda obj: 'thing')
+        assert_equal(utils.msgpack_encode_default(self.Thing()), 'thing')
+
+    def test_subclass(self):
+        utils.register_encoder(self.Thing, lambda obj: 'thing')
+        assert_equal(utils.msgpack_encode_default(self.SubThing()), 'thing')
+
+    def test_override(self):
+        utils.msgpack_encode_default(decimal.Decimal('1.0'))
+
+        utils.register_encoder(decimal.Decimal, float)
+        assert_equal(utils.msgpack_encode_default(decimal.Decimal('1.5')), 1.5)
+
+
+class CompileKeyTestCase(TestCase):
+    def test(self):
+        c_key, elems, ancestors, invalid_index = utils.compile_key('foo.bar.2')
+        assert_equal(c_key, 'foo.bar.2')
+        assert_equal(elems, ('foo', 'bar', 2))
+        assert_equal(ancestors, ('foo', 'foo.bar'))
+        assert_equal(invalid_index, None)
+
+    def test_invalid_index(self):
+        assert_equal(utils.compile_key('foo.2.bar')[3], 2)
+
+
+class FlatStoreTestCase(TestCase):
+    @setup
+    def build_store(self):
+        self.store = utils.FlatStore()
+
+    def test_simple(self):
+        self.store.set('foo', True)
+        self.store.set('bar.baz', 10)
+
+        assert_equal(self.store.get('foo'), True)
+        assert_equal(self.store.get('bar.baz'), 10)
+        assert_equal(self.store.get('bar.zoo', 5), 5)
+        assert_equal(self.store.to_dict(), {'foo': True, 'bar': {'baz': 10}})
+
+    def test_get_below(self):
+        self.store.set('foo', {'bar': [{'baz': True}]})
+
+        assert_equal(self.store.get('foo.bar.0.baz'), True)
+        assert_equal(self.store.get('foo.bar.1.baz', 5), 5)
+
+    def test_get_above(self):
+        self.store.set('foo.bar', 1)
+        self.store.set('foo.baz', 2)
+
+        assert_equal(self.store.get('foo'), {'bar': 1, 'baz': 2})
+
+    def test_set_below(self):
+        self.store.set('foo', {'bar': 1})
+        self.store.set('foo.baz.zoo', 2)
+
+        assert_equal(self.store.to_dict(),
+                     {'foo': {'bar': 1, 'baz': {'zoo': 2}}})
+
+    def test_set_above(self):
+        self.store.set('foo.bar', 1)
+        self.store.set('foo.baz.zoo', 2)
+        self.store.set('foo', 3)
+
+        assert_equal(self.store.to_dict(), {'foo': 3})
+        assert_equal(self.store.prefixes, {})
+
+    def test_index(self):
+        self.store.set('foo.1', True)
+        assert_equal(self.store.to_dict(), {'foo': {1: True}})
+
+    def test_invalid_index(self):
+        with assert_raises(ValueError):
+            self.store.set('foo.1.bar', True)
+
+    def test_matches_set_deep(self):
+        operations = [('a', 1), ('b.c', 2), ('b.d.e', 3), ('b.d', {'f': 4}),
+                      ('b.d.g', 5), ('a', 6), ('h.1', 7), ('b', 8),
+                      ('b.x', 9)]
+
+        nested = {}
+        for key, value in operations:
+            if key == 'b.x':
+                # Would fail for both, b is now an int.
+                continue
+
+            utils.set_deep(nested, key, value)
+            self.store.set(key, value)
+            assert_equal(self.store.to_dict(), nested)
+            assert_equal(self.store.tree, nested)
+
+    def test_tree(self):
+        self.store.set('foo', {'bar': 1})
+        self.store.set('foo.baz', 2)
+        self.store.set('zoo.a.b', 3)
+        self.store.set('zoo.a.b', 4)
+        self.store.set('zoo.c', 5)
+        self.store.set('zoo.a', 6)
+
+        assert_equal(self.store.tree, self.store.to_dict())
+        assert_equal(self.store.tree,
+                     {'foo': {'bar': 1, 'baz': 2}, 'zoo': {'a': 6, 'c': 5}})
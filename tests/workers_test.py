@@ -0,0 +1,124 @@
+import multiprocessing
+from multiprocessing import pool as mp_pool
+
+from testify import *
+
+import blueox
+from blueox import context
+from blueox import workers
+
+
+def current_context_info():
+    ctx = context.current_context()
+    return ctx.id, ctx.name, ctx.enabled
+
+
+class TaskTestCase(TestCase):
+    def test(self):
+        with blueox.Context('test') as parent:
+            task = workers.Task(current_context_info)
+
+        assert_equal(task(), (parent.id, 'test.task', True))
+        assert_equal(context.current_context(), None)
+
+    def test_no_parent(self):
+        task = workers.Task(context.current_context)
+        assert_equal(task(), None)
+
+    def test_disabled(self):
+        with blueox.Context('test') as parent:
+            parent.enabled = False
+            task = workers.Task(current_context_info)
+
+        assert_equal(task(), (parent.id, 'test.task', False))
+
+    def test_type_name(self):
+        with blueox.Context('test'):
+            task = workers.Task(current_context_info, '.fetch')
+            assert_equal(task()[1], 'test.fetch')
+
+    def test_absolute_type_name(self):
+        with blueox.Context('test'):
+            task = workers.Task(current_context_info, 'fetch')
+            assert_equal(task()[1], 'fetch')
+
+            task = workers.Task(current_context_info, 'test.fetch')
+            assert_equal(task()[1], 'test.fetch')
+
+    def test_record(self):
+        children = []
+
+        def func():
+            children.append(context.current_context())
+
+        with blueox.Context('test') as parent:
+            task = workers.Task(func)
+            task()
+            task()
+
+        assert_equal(children[0].data['queue_time'] >= 0.0, True)
+        assert_equal(children[0].data['run_time'] >= 0.0, True)
+        assert_equal(parent.data['tasks']['queue_time']['count'], 2)
+        assert_equal(parent.data['tasks']['run_time']['count'], 2)
+
+    def test_parent_done(self):
+        with blueox.Context('test') as parent:
+            task = workers.Task(lambda: None)
+
+        task()
+        assert_not_in('tasks', parent.data)
+
+    def test_record_fails(self):
+        def fail(*args):
+            # Like the parent finishing between our check and our update.
+            raise ValueError("Context not writable")
+
+        update_histogram = workers.timer.update_histogram
+        workers.timer.update_histogram = fail
+        try:
+            with blueox.Context('test'):
+                task = workers.Task(lambda: 'result')
+                assert_equal(task(), 'result')
+        finally:
+            workers.timer.update_histogram = update_histogram
+
+
+class ThreadPoolTestCase(TestCase):
+    @setup
+    def build_pool(self):
+        self.pool = blueox.executor(mp_pool.ThreadPool(2))
+
+    @teardown
+    def close_pool(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test_map(self):
+        with blueox.Context('test') as parent:
+            results = self.pool.map(lambda _: current_context_info(), range(4))
+
+        assert_equal(results, [(parent.id, 'test.task', True)] * 4)
+        assert_equal(parent.data['tasks']['run_time']['count'], 4)
+
+    def test_apply_async(self):
+        with blueox.Context('test') as parent:
+            result = self.pool.apply_async(current_context_info).get()
+
+        assert_equal(result, (parent.id, 'test.task', True))
+
+
+class ProcessPoolTestCase(TestCase):
+    @setup
+    def build_pool(self):
+        self.pool = blueox.executor(multiprocessing.Pool(1))
+
+    @teardown
+    def close_pool(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test(self):
+        with blueox.Context('test') as parent:
+            result = self.pool.apply(current_context_info)
+
+        assert_equal(result, (parent.id, 'test.task', True))